@@ -3,10 +3,20 @@ API Flask - CicloRota BH
 Roteamento ciclistico com duas rotas: rapida (distancia) e segura (considera elevacao).
 """
 
-import os, traceback
+import multiprocessing, os, shutil, threading, time, traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from decimal import Decimal
 from pathlib import Path
+import numpy as np
+import orjson
 import psycopg
-from flask import Flask, jsonify, request, send_from_directory, make_response
+from psycopg.types.string import TextLoader
+from psycopg_pool import ConnectionPool
+from flask import Flask, Response, jsonify, request, send_from_directory, make_response
+from flask.json.provider import JSONProvider
+from cache import RouteCache
+from grafo import Graph, CUSTO_PADRAO, PERFIS, PERFIS_CUSTO, SNAP_VIZINHOS, snapshot_matrix
 
 DB = os.getenv("PGDATABASE", "ciclorota_bh")
 USER = os.getenv("PGUSER", "postgres")
@@ -14,13 +24,190 @@ PWD = os.getenv("PGPASSWORD", "postgres")
 HOST = os.getenv("PGHOST", "localhost")
 PORT = os.getenv("PGPORT", "5432")
 SRID = 31983
+# Schema publicado pelo setup (troca atomica); public continua no search_path so pelas
+# funcoes do PostGIS e do pgRouting. Bancos no layout antigo (tabelas em public) nao
+# tem comp_*/ilha_*, geom_4326 nem subida_m: e preciso rodar o setup de novo
+SCHEMA = os.getenv("PGSCHEMA", "ciclorota")
+OPTIONS = f"-c search_path={SCHEMA},public"
+# pgrouting: pgr_dijkstra a cada requisicao | memoria: grafo CSR carregado no processo
+ENGINE = os.getenv("ROUTING_ENGINE", "pgrouting")
+# Algoritmo do motor em memoria: dijkstra | astar (A* bidirecional) | ch (contraction hierarchy)
+# | alt (A* com limites dos landmarks)
+ALGORITHM = os.getenv("ROUTING_ALGORITHM", "dijkstra")
+POOL_MIN = int(os.getenv("PGPOOL_MIN", "2"))
+POOL_MAX = int(os.getenv("PGPOOL_MAX", "10"))
+ROUTE_CACHE_SIZE = int(os.getenv("ROUTE_CACHE_SIZE", "1024"))
+ROUTE_CACHE_TTL = int(os.getenv("ROUTE_CACHE_TTL", "3600"))
+# Linhas por lote no modo stream=1 das camadas
+STREAM_BATCH = int(os.getenv("STREAM_BATCH", "2000"))
+TILE_CACHE_DIR = Path(os.getenv("TILE_CACHE_DIR", Path(__file__).parent / "cache_tiles"))
+# Intervalo (s) entre leituras da versao da rede pelos tiles servidos do cache em disco
+TILE_VERSION_TTL = float(os.getenv("TILE_VERSION_TTL", "30"))
+# Intervalo (s) entre leituras da versao da rede pelas rotas, lote, matriz e alcance
+NETWORK_VERSION_TTL = float(os.getenv("NETWORK_VERSION_TTL", "30"))
+# Rotas em lote: maximo de pares por requisicao e origens por consulta ao banco
+LOTE_MAX = int(os.getenv("LOTE_MAX", "50000"))
+LOTE_ORIGENS = int(os.getenv("LOTE_ORIGENS", "50"))
+# Matriz origem-destino: maximo de pontos de cada lado
+MATRIZ_MAX = int(os.getenv("MATRIZ_MAX", "1000"))
+# Processos da matriz sobre o snapshot (o Dijkstra do scipy segura o GIL, threads nao
+# paralelizam), por padrao um por nucleo; 0 calcula os perfis um apos o outro na
+# propria requisicao
+MATRIZ_PROCESSOS = int(os.getenv("MATRIZ_PROCESSOS", str(os.cpu_count() or 1)))
+# Alcance: custo maximo da busca (arvore guardada serve qualquer orcamento ate ele),
+# arvores em cache (float32, 4 bytes por vertice cada) e parametro do ST_ConcaveHull
+# (1 = envoltoria convexa)
+ALCANCE_MAX = float(os.getenv("ALCANCE_MAX", "30000"))
+ALCANCE_CACHE_SIZE = int(os.getenv("ALCANCE_CACHE_SIZE", "256"))
+ALCANCE_HULL = float(os.getenv("ALCANCE_HULL", "0.7"))
+# Snapping: um vertice da componente principal ate SNAP_FOLGA m alem do mais proximo
+# tem preferencia sobre ilhas da rede (vias de servico isoladas, fragmentos do LineMerge)
+SNAP_FOLGA = float(os.getenv("SNAP_FOLGA", "50"))
+# Snapshot do grafo exportado pelo setup (aberto com mmap, dividido entre os workers)
+GRAFO_SNAPSHOT = Path(os.getenv("GRAFO_SNAPSHOT", Path(__file__).parent / "grafo_snapshot"))
+
+
+def _json_default(o):
+    if isinstance(o, Decimal):
+        return str(o)
+    raise TypeError(f"Tipo nao serializavel: {type(o).__name__}")
+
+
+class OrjsonProvider(JSONProvider):
+    """jsonify via orjson; orjson.Fragment repassa JSON pronto (ex.: geometria) sem reparse."""
+
+    def dumps(self, obj, **kwargs):
+        return self.dumpb(obj).decode()
+
+    def dumpb(self, obj):
+        return orjson.dumps(obj, default=_json_default, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumpb(obj), mimetype="application/json")
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 STATIC = Path(__file__).parent / "static"
 
+_graph = None
+_graph_lock = threading.Lock()
+route_cache = RouteCache(ROUTE_CACHE_SIZE, ROUTE_CACHE_TTL)
+reach_cache = RouteCache(ALCANCE_CACHE_SIZE, ROUTE_CACHE_TTL)
+
 
 def get_conn():
-    return psycopg.connect(dbname=DB, user=USER, password=PWD, host=HOST, port=PORT)
+    return psycopg.connect(dbname=DB, user=USER, password=PWD, host=HOST, port=PORT,
+                           options=OPTIONS)
+
+
+# Conexoes reaproveitadas entre requisicoes; check valida cada uma antes do uso.
+# Aberto na primeira requisicao (ou no __main__): importar o modulo nao conecta ao banco
+pool = ConnectionPool(
+    psycopg.conninfo.make_conninfo(dbname=DB, user=USER, password=PWD, host=HOST, port=PORT,
+                                   options=OPTIONS),
+    min_size=POOL_MIN, max_size=POOL_MAX,
+    check=ConnectionPool.check_connection, open=False,
+)
+_pool_lock = threading.Lock()
+# Snaps e perfis de uma mesma rota rodam em paralelo, cada um com sua conexao
+executor = ThreadPoolExecutor(max_workers=POOL_MAX, thread_name_prefix="rota")
+
+
+def open_pool():
+    if pool.closed:
+        with _pool_lock:
+            if pool.closed:
+                pool.open()
+
+
+def open_snapshot():
+    """Grafo do snapshot do setup, ou None.
+
+    None se nao houver snapshot, se for de outra versao da rede ou de um formato
+    anterior (o proximo setup o exporta de novo).
+    """
+    try:
+        versao = (GRAFO_SNAPSHOT / "atual").read_text().strip()
+    except FileNotFoundError:
+        return None
+    if route_cache.version is not None and versao != route_cache.version:
+        return None
+    try:
+        return Graph.open(GRAFO_SNAPSHOT / versao)
+    except (ValueError, FileNotFoundError) as e:
+        print(f"Snapshot do grafo ignorado: {e}")
+        return None
+
+
+def get_graph():
+    """Carrega a rede em memoria uma unica vez (ROUTING_ENGINE=memoria).
+
+    Usa o snapshot mapeado em memoria quando existe; senao le a tabela rede.
+    """
+    global _graph
+    with _graph_lock:
+        if _graph is None:
+            _graph = open_snapshot()
+            if (_graph is None or (ALGORITHM == "ch" and not _graph.ch)
+                    or (ALGORITHM == "alt" and not _graph.landmarks)):
+                with pool.connection() as c:
+                    cur = c.cursor()
+                    if _graph is None:
+                        _graph = Graph.from_db(cur)
+                    # Perfis sem CH / landmarks validos (pesos alterados) usam A* bidirecional
+                    if ALGORITHM == "ch" and not _graph.ch:
+                        _graph.load_ch(cur)
+                    elif ALGORITHM == "alt" and not _graph.landmarks:
+                        _graph.load_alt(cur)
+    return _graph
+
+
+_versao_lida = None  # (instante da leitura, versao)
+_versao_lock = threading.Lock()
+
+
+def check_network_version():
+    """Le o carimbo gravado pelo setup; se a rede mudou, esvazia o cache e recarrega o grafo.
+
+    O banco e consultado no maximo a cada NETWORK_VERSION_TTL s; entre as leituras
+    (inclusive nos acertos do cache de rotas) vale a ultima versao lida.
+    Retorna a versao atual (None em bancos anteriores ao carimbo).
+    """
+    global _graph, _versao_lida
+    with _versao_lock:
+        atual = _versao_lida
+    if atual is not None and time.monotonic() - atual[0] < NETWORK_VERSION_TTL:
+        return atual[1]
+    with pool.connection() as c:
+        cur = c.cursor()
+        try:
+            cur.execute("SELECT versao FROM rede_versao", prepare=True)
+            row = cur.fetchone()
+        except psycopg.errors.UndefinedTable:
+            row = None
+    versao = row[0] if row else None
+    with _versao_lock:
+        _versao_lida = (time.monotonic(), versao)
+    anterior = route_cache.version
+    reach_cache.set_version(versao)
+    mudou = route_cache.set_version(versao)
+    # Na primeira leitura (anterior None) o grafo ja carregado e o atual, salvo um
+    # snapshot de outra versao
+    with _graph_lock:
+        if _graph is not None and (mudou and anterior is not None
+                                   or _graph.versao not in (None, versao)):
+            _graph = None
+    return versao
+
+
+@app.before_request
+def before():
+    open_pool()
 
 
 @app.after_request
@@ -39,57 +226,157 @@ def index():
 @app.route("/api/status")
 def status():
     try:
-        c = get_conn()
-        cur = c.cursor()
-        cur.execute("SELECT COUNT(*) FROM rede")
-        edges = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM rede_vertices_pgr")
-        verts = cur.fetchone()[0]
-        cur.close(); c.close()
-        return jsonify({"ok": True, "arestas": edges, "vertices": verts})
+        with pool.connection() as c:
+            cur = c.cursor()
+            cur.execute("SELECT COUNT(*) FROM rede", prepare=True)
+            edges = cur.fetchone()[0]
+            cur.execute("SELECT COUNT(*) FROM rede_vertices_pgr", prepare=True)
+            verts = cur.fetchone()[0]
+        return jsonify({"ok": True, "arestas": edges, "vertices": verts, "motor": ENGINE,
+                        "algoritmo": ALGORITHM if ENGINE == "memoria" else "pgr_dijkstra",
+                        "pool": pool.get_stats(), "cache_rotas": route_cache.stats(),
+                        "cache_alcance": reach_cache.stats(),
+                        "grafo_snapshot": getattr(_graph, "versao", None)})
     except Exception as e:
-        return jsonify({"error": str(e)}), 503
+        return jsonify({"error": str(e), "pool": pool.get_stats()}), 503
 
 
-def find_vertex(cur, lat, lng):
-    cur.execute(f"""
-        SELECT id FROM rede_vertices_pgr
-        ORDER BY geom <-> ST_Transform(ST_SetSRID(ST_MakePoint(%s, %s), 4326), {SRID})
+def snap_sql(ponto):
+    """Vertice mais proximo de `ponto` (SQL), preferindo a componente principal.
+
+    Entre os SNAP_VIZINHOS vizinhos (KNN no indice GIST) fica o mais proximo da
+    componente principal de todos os perfis, se estiver ate SNAP_FOLGA alem do primeiro.
+    Retorna id e a ilha do vertice em cada perfil (ilha_{perfil}).
+    """
+    principal = " AND ".join(f"comp_{p} = 0" for p in PERFIS)
+    ilhas = ", ".join(f"ilha_{p}" for p in PERFIS)
+    return f"""
+        SELECT id, {ilhas} FROM (
+            SELECT id, {ilhas}, d, {principal} AS principal, MIN(d) OVER () AS d_min
+            FROM (
+                SELECT id, {", ".join(f"comp_{p}" for p in PERFIS)}, {ilhas}, geom <-> {ponto} AS d
+                FROM rede_vertices_pgr
+                ORDER BY geom <-> {ponto}
+                LIMIT {SNAP_VIZINHOS}
+            ) k
+        ) k
+        ORDER BY NOT (principal AND d <= d_min + {SNAP_FOLGA}), d
         LIMIT 1
-    """, (lng, lat))
+    """
+
+
+SQL_SNAP = snap_sql(f"ST_Transform(ST_SetSRID(ST_MakePoint(%(lng)s, %(lat)s), 4326), {SRID})")
+
+
+def find_vertex(cur, lat, lng):
+    """(id, ilhas por perfil) do vertice mais proximo, ou (None, None)."""
+    cur.execute(SQL_SNAP, {"lng": lng, "lat": lat}, prepare=True)
     row = cur.fetchone()
-    return row[0] if row else None
+    return (row[0], row[1:]) if row else (None, None)
+
 
+def split_components(start, end):
+    """Perfis em que origem e destino estao em ilhas diferentes (sem caminho possivel).
 
-def run_dijkstra(cur, cost_sql, start, end):
+    start e end sao os (vertice, ilhas) de _snap: no pgRouting as ilhas vem do
+    proprio snap, sem outra consulta; no motor em memoria, do grafo.
+    """
+    if ENGINE == "memoria":
+        g = get_graph()
+        return {p for p in PERFIS if not g.same_component(p, start[0], end[0])}
+    return {p for p, a, b in zip(PERFIS, start[1], end[1]) if a != b or a < 0}
+
+
+def run_dijkstra(cur, cost_sql, start, end, precisao=9):
     escaped = cost_sql.replace("'", "''")
     cur.execute(f"""
         SELECT di.seq, di.edge,
                r.logradouro, r.tipo_logradouro, r.comprimento,
                r.elev_source, r.elev_target,
                r.eh_rodovia, r.eh_obra_arte, r.eh_ciclovia,
-               ST_AsGeoJSON(ST_Transform(r.the_geom, 4326))::json AS geojson
+               r.subida_m, r.descida_m,
+               ST_AsGeoJSON(r.geom_4326, %s) AS geojson
         FROM pgr_dijkstra('{escaped}', %s, %s, directed := true) di
         JOIN rede r ON di.edge = r.id
         ORDER BY di.seq
-    """, (start, end))
+    """, (precisao, start, end), prepare=True)
     return cur.fetchall()
 
 
+def fetch_edges(cur, edges, precisao=9, grafo=None):
+    """Atributos e geometria das arestas de um caminho, no mesmo formato de run_dijkstra.
+
+    Com o snapshot, logradouro, tipo e elevacoes das pontas vem das tabelas do grafo
+    mapeadas em memoria; o banco envia so os ids das pontas e o resto da aresta.
+    """
+    if not edges:
+        return []
+    if grafo is not None and grafo.has_names:
+        cur.execute("""
+            SELECT p.seq, p.edge, r.source, r.target, r.comprimento,
+                   r.eh_rodovia, r.eh_obra_arte, r.eh_ciclovia,
+                   r.subida_m, r.descida_m,
+                   ST_AsGeoJSON(r.geom_4326, %s) AS geojson
+            FROM unnest(%s::int[]) WITH ORDINALITY AS p(edge, seq)
+            JOIN rede r ON p.edge = r.id
+            ORDER BY p.seq
+        """, (precisao, edges), prepare=True)
+        rows = cur.fetchall()
+        nomes = grafo.names([r[1] for r in rows])
+        es = grafo.elevations([r[2] for r in rows])
+        et = grafo.elevations([r[3] for r in rows])
+        return [(seq, edge, logr, tipo, comp, s, t, *resto)
+                for (seq, edge, _, _, comp, *resto), (logr, tipo), s, t in zip(rows, nomes, es, et)]
+    cur.execute("""
+        SELECT p.seq, p.edge,
+               r.logradouro, r.tipo_logradouro, r.comprimento,
+               r.elev_source, r.elev_target,
+               r.eh_rodovia, r.eh_obra_arte, r.eh_ciclovia,
+               r.subida_m, r.descida_m,
+               ST_AsGeoJSON(r.geom_4326, %s) AS geojson
+        FROM unnest(%s::int[]) WITH ORDINALITY AS p(edge, seq)
+        JOIN rede r ON p.edge = r.id
+        ORDER BY p.seq
+    """, (precisao, edges), prepare=True)
+    return cur.fetchall()
+
+
+def _round1(valores):
+    """round(x, 1) de uma lista de valores; ints continuam ints, como no round do Python.
+
+    Arredonda em NumPy e so repete o round do Python onde x * 10 fica perto de ,5
+    (ou fora da faixa em que o erro da multiplicacao e desprezivel).
+    """
+    a = np.array(valores, dtype=np.float64)
+    y = a * 10
+    r = (np.rint(y) / 10).tolist()
+    with np.errstate(invalid="ignore"):
+        duvida = ~(np.abs(y - np.floor(y) - 0.5) > 1e-6) | ~(np.abs(y) < 1e9)
+    for i in np.flatnonzero(duvida).tolist():
+        r[i] = round(valores[i], 1)
+    return [v if type(v) is int else x for v, x in zip(valores, r)]
+
+
 def build_geojson(rows):
-    features = []
-    dist = 0.0
-    subida_total = 0.0
-    descida_total = 0.0
-    trechos_rodovia = 0
-    trechos_obra_arte = 0
-    trechos_ciclovia = 0
-    dist_rodovia = 0.0
-    dist_obra_arte = 0.0
-    dist_ciclovia = 0.0
+    """Trechos e resumo da rota numa unica passada pelas linhas do caminho.
+
+    Com subida_m/descida_m nas linhas (antes do geojson), os totais do resumo usam a
+    subida e a descida amostradas ao longo de cada aresta; sem elas, o desnivel das pontas.
+    """
+    features, props, brutos = [], [], []
+    add, fragment = features.append, orjson.Fragment
+    dist = subida_total = descida_total = 0.0
+    trechos_rodovia = trechos_obra_arte = trechos_ciclovia = 0
+    dist_rodovia = dist_obra_arte = dist_ciclovia = 0.0
+    amostrada = bool(rows) and len(rows[0]) == 13
+    sub = desc = 0
     prev_elev = None
 
-    for seq, edge_id, logr, tipo, comp, es, et, rod, oa, cic, geojson in rows:
+    for row in rows:
+        if amostrada:
+            seq, _, logr, tipo, comp, es, et, rod, oa, cic, sub, desc, geojson = row
+        else:
+            seq, _, logr, tipo, comp, es, et, rod, oa, cic, geojson = row
         comp = comp or 0
         es = es or 0
         et = et or 0
@@ -105,42 +392,46 @@ def build_geojson(rows):
             dist_ciclovia += comp
 
         # Ajusta sentido do trecho pela continuidade da rota
-        if prev_elev is not None and es > 0 and et > 0:
-            if abs(es - prev_elev) <= abs(et - prev_elev):
-                ei, ef = es, et
-            else:
-                ei, ef = et, es
+        if prev_elev is not None and es > 0 and et > 0 and abs(es - prev_elev) > abs(et - prev_elev):
+            ei, ef = et, es
+            # Aresta percorrida de target para source: a subida e a descida amostrada
+            sub, desc = desc, sub
         else:
             ei, ef = es, et
-
         desnivel = ef - ei
-        slope = (desnivel / comp * 100) if comp > 0 else 0
         prev_elev = ef
 
-        if desnivel > 0:
+        if amostrada:
+            subida_total += sub or 0
+            descida_total += desc or 0
+        elif desnivel > 0:
             subida_total += desnivel
         else:
-            descida_total += abs(desnivel)
+            descida_total -= desnivel
+        dist += comp
 
         if geojson:
-            features.append({
-                "type": "Feature",
-                "geometry": geojson,
-                "properties": {
-                    "seq": seq,
-                    "logradouro": logr or "",
-                    "tipo": tipo or "",
-                    "comprimento": round(comp, 1),
-                    "elev_inicio": round(ei, 1),
-                    "elev_fim": round(ef, 1),
-                    "desnivel": round(desnivel, 1),
-                    "inclinacao": round(slope, 1),
-                    "eh_rodovia": bool(rod),
-                    "eh_obra_arte": bool(oa),
-                    "eh_ciclovia": bool(cic),
-                },
-            })
-        dist += comp
+            # Valores arredondados depois, todos de uma vez
+            brutos += comp, ei, ef, desnivel, desnivel / comp * 100 if comp > 0 else 0
+            p = {
+                "seq": seq,
+                "logradouro": logr or "",
+                "tipo": tipo or "",
+                "comprimento": None,
+                "elev_inicio": None,
+                "elev_fim": None,
+                "desnivel": None,
+                "inclinacao": None,
+                "eh_rodovia": True if rod else False,
+                "eh_obra_arte": True if oa else False,
+                "eh_ciclovia": True if cic else False,
+            }
+            props.append(p)
+            add({"type": "Feature", "geometry": fragment(geojson), "properties": p})
+
+    r = _round1(brutos)
+    for p, c, ei, ef, d, s in zip(props, r[0::5], r[1::5], r[2::5], r[3::5], r[4::5]):
+        p["comprimento"], p["elev_inicio"], p["elev_fim"], p["desnivel"], p["inclinacao"] = c, ei, ef, d, s
 
     return {
         "rota": {"type": "FeatureCollection", "features": features},
@@ -159,96 +450,403 @@ def build_geojson(rows):
     }
 
 
+# Formatos compactos de rota
+
+TRECHO_COLUNAS = ("seq", "logradouro", "tipo", "comprimento", "elev_inicio", "elev_fim",
+                  "desnivel", "inclinacao", "eh_rodovia", "eh_obra_arte", "eh_ciclovia")
+
+
+def encode_polyline(coords, precision=6):
+    """Encoded polyline (algoritmo do Google) de pontos [lng, lat]; precision=6 e a polyline6."""
+    factor = 10 ** precision
+    out = []
+    prev_lat = prev_lng = 0
+    for lng, lat in coords:
+        lat_i, lng_i = round(lat * factor), round(lng * factor)
+        for d in (lat_i - prev_lat, lng_i - prev_lng):
+            d = ~(d << 1) if d < 0 else d << 1
+            while d >= 0x20:
+                out.append(chr((0x20 | (d & 0x1f)) + 63))
+                d >>= 5
+            out.append(chr(d + 63))
+        prev_lat, prev_lng = lat_i, lng_i
+    return "".join(out)
+
+
+def _d2(a, b):
+    return (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2
+
+
+def build_polyline(rows):
+    """Rota como uma unica polyline6 + tabela de atributos por trecho.
+
+    Cada trecho traz `ponto`, o indice do seu primeiro ponto na polyline
+    decodificada. O resumo e o mesmo de build_geojson.
+    """
+    g = build_geojson(rows)
+    lines = [orjson.loads(row[-1])["coordinates"] for row in rows if row[-1]]
+
+    coords, trechos = [], []
+    for i, (line, f) in enumerate(zip(lines, g["rota"]["features"])):
+        # Orienta cada aresta pela continuidade com a anterior (ou a seguinte, na primeira)
+        if coords:
+            if _d2(coords[-1], line[-1]) < _d2(coords[-1], line[0]):
+                line = line[::-1]
+        elif i + 1 < len(lines):
+            nxt = lines[i + 1]
+            if min(_d2(line[0], nxt[0]), _d2(line[0], nxt[-1])) < \
+                    min(_d2(line[-1], nxt[0]), _d2(line[-1], nxt[-1])):
+                line = line[::-1]
+        if coords and line[0] == coords[-1]:
+            ponto = len(coords) - 1
+            coords.extend(line[1:])
+        else:
+            ponto = len(coords)
+            coords.extend(line)
+        p = f["properties"]
+        trechos.append([p[c] for c in TRECHO_COLUNAS] + [ponto])
+
+    return {
+        "rota": {
+            "formato": "polyline6",
+            "polyline": encode_polyline(coords, 6),
+            "colunas": list(TRECHO_COLUNAS) + ["ponto"],
+            "trechos": trechos,
+        },
+        "resumo": g["resumo"],
+    }
+
+
 # Camadas GeoJSON
 
+# Colunas pre-calculadas no setup: geom_4326 e versoes simplificadas por faixa de zoom
+GEOM_ZOOM_BANDS = ((12, "geom_4326_z12"), (14, "geom_4326_z14"))
+
+
+def geom_column(zoom):
+    """Coluna de geometria (SRID 4326) adequada ao zoom; resolucao completa sem zoom."""
+    if zoom is not None:
+        for max_zoom, col in GEOM_ZOOM_BANDS:
+            if zoom <= max_zoom:
+                return col
+    return "geom_4326"
+
+
 LAYER_CONFIG = {
     "ciclovia": {
         "sql": """SELECT id_rota, nome_lograd, tipo_rota, situacao,
-                         ST_AsGeoJSON(ST_Transform(geom, 4326))::json AS geojson
+                         ST_AsGeoJSON({geom})::json AS geojson
                   FROM rota_cicloviaria WHERE geom IS NOT NULL""",
         "props": lambda r: {"nome": r[1] or "", "tipo": r[2] or "", "situacao": r[3] or ""},
+        "props_sql": """json_build_object('nome', COALESCE(nome_lograd, ''), 'tipo', COALESCE(tipo_rota, ''),
+                                          'situacao', COALESCE(situacao, ''))""",
     },
     "rodovia": {
         "sql": """SELECT id_fx_rod,
-                         ST_AsGeoJSON(ST_Transform(geom, 4326))::json AS geojson
+                         ST_AsGeoJSON({geom})::json AS geojson
                   FROM faixa_rodagem_rodovia WHERE geom IS NOT NULL""",
         "props": lambda r: {"id": r[0]},
+        "props_sql": "json_build_object('id', id_fx_rod)",
     },
     "obra_arte": {
         "sql": """SELECT id_obrart, tipo_obra, denominacao,
-                         ST_AsGeoJSON(ST_Transform(geom, 4326))::json AS geojson
+                         ST_AsGeoJSON({geom})::json AS geojson
                   FROM logradouro_obra_de_arte WHERE geom IS NOT NULL""",
         "props": lambda r: {"tipo": r[1] or "", "nome": r[2] or ""},
+        "props_sql": "json_build_object('tipo', COALESCE(tipo_obra, ''), 'nome', COALESCE(denominacao, ''))",
     },
 }
 
 
+def feature_collection_sql(sql, props_sql):
+    """Envolve a consulta da camada para o banco devolver o FeatureCollection pronto (texto)."""
+    return f"""
+        SELECT json_build_object(
+            'type', 'FeatureCollection',
+            'features', COALESCE(json_agg(json_build_object(
+                'type', 'Feature',
+                'geometry', geojson,
+                'properties', {props_sql}
+            )) FILTER (WHERE geojson IS NOT NULL), '[]'::json)
+        )::text
+        FROM ({sql}) src
+    """
+
+
+def query_feature_collection(sql, params=()):
+    """Executa feature_collection_sql e repassa os bytes ao cliente sem reparse."""
+    with pool.connection() as c:
+        cur = c.cursor()
+        cur.execute(sql, params, prepare=True)
+        body = cur.fetchone()[0]
+    return Response(body, mimetype="application/json")
+
+
 @app.route("/api/camada/<nome>")
 def camada(nome):
+    """Camada como FeatureCollection; com stream=1 a resposta e enviada em pedacos."""
+    stream = request.args.get("stream") == "1"
     if nome == "circulacao_viaria":
-        return _camada_circulacao()
+        return _camada_circulacao(stream)
 
     cfg = LAYER_CONFIG.get(nome)
     if not cfg:
         return jsonify({"error": f"Camada '{nome}' nao existe"}), 404
 
+    sql = cfg["sql"].format(geom=geom_column(request.args.get("zoom", type=int)))
+    if stream:
+        return stream_features(sql, (), cfg["props"])
     try:
-        c = get_conn()
-        cur = c.cursor()
-        cur.execute(cfg["sql"])
-        features = []
-        for row in cur.fetchall():
-            geojson = row[-1]
-            if geojson:
-                features.append({
-                    "type": "Feature",
-                    "geometry": geojson,
-                    "properties": cfg["props"](row),
-                })
-        cur.close(); c.close()
-        return jsonify({"type": "FeatureCollection", "features": features})
+        return query_feature_collection(feature_collection_sql(sql, cfg["props_sql"]))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
-def _camada_circulacao():
+SQL_CIRCULACAO_BBOX = """
+    SELECT tipo_logradouro, logradouro,
+           ST_AsGeoJSON({geom})::json AS geojson
+    FROM rede
+    WHERE {geom} && ST_MakeEnvelope(%s, %s, %s, %s, 4326)
+"""
+SQL_CIRCULACAO = """
+    SELECT tipo_logradouro, logradouro,
+           ST_AsGeoJSON({geom})::json AS geojson
+    FROM rede
+"""
+PROPS_CIRCULACAO_SQL = "json_build_object('tipo', COALESCE(tipo_logradouro, ''), 'logradouro', COALESCE(logradouro, ''))"
+
+
+def _camada_circulacao(stream=False):
     """Circulacao viaria filtrada por bounding box (query param bbox=w,s,e,n)."""
     bbox = request.args.get("bbox", "")
+    geom = geom_column(request.args.get("zoom", type=int))
+    props = lambda r: {"tipo": r[0] or "", "logradouro": r[1] or ""}
     try:
-        c = get_conn()
-        cur = c.cursor()
         if bbox:
             w, s, e, n = [float(x) for x in bbox.split(",")]
-            cur.execute(f"""
-                SELECT tipo_logradouro, logradouro,
-                       ST_AsGeoJSON(ST_Transform(the_geom, 4326))::json
-                FROM rede
-                WHERE the_geom && ST_Transform(
-                    ST_MakeEnvelope(%s, %s, %s, %s, 4326), {SRID})
-            """, (w, s, e, n))
+            sql, params = SQL_CIRCULACAO_BBOX.format(geom=geom), (w, s, e, n)
+        elif stream:
+            sql, params = SQL_CIRCULACAO.format(geom=geom), ()
         else:
-            cur.execute("""
-                SELECT tipo_logradouro, logradouro,
-                       ST_AsGeoJSON(ST_Transform(the_geom, 4326))::json
-                FROM rede LIMIT 50000
-            """)
-
-        features = []
-        for tipo, logr, geojson in cur.fetchall():
-            if geojson:
-                features.append({
-                    "type": "Feature",
-                    "geometry": geojson,
-                    "properties": {"tipo": tipo or "", "logradouro": logr or ""},
-                })
-        cur.close(); c.close()
-        return jsonify({"type": "FeatureCollection", "features": features})
+            sql, params = SQL_CIRCULACAO.format(geom=geom) + " LIMIT 50000", ()
+        if stream:
+            return stream_features(sql, params, props)
+        return query_feature_collection(feature_collection_sql(sql, PROPS_CIRCULACAO_SQL), params)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+def stream_features(sql, params, props):
+    """FeatureCollection gerado aos poucos a partir de um cursor nomeado (memoria limitada).
+
+    A geometria chega como texto (sem parse para dict) e e copiada direto na saida.
+    """
+    def generate():
+        with pool.connection() as c:
+            cur = c.cursor(name="camada_stream")
+            cur.itersize = STREAM_BATCH
+            cur.adapters.register_loader("json", TextLoader)
+            cur.execute(sql, params)
+            yield '{"type":"FeatureCollection","features":['
+            buf, sep = [], ""
+            for row in cur:
+                geojson = row[-1]
+                if not geojson:
+                    continue
+                buf.append(f'{sep}{{"type":"Feature","geometry":{geojson},'
+                           f'"properties":{orjson.dumps(props(row)).decode()}}}')
+                sep = ","
+                if len(buf) >= STREAM_BATCH:
+                    yield "".join(buf)
+                    buf = []
+            buf.append("]}")
+            yield "".join(buf)
+            cur.close()
+
+    return Response(generate(), mimetype="application/json")
+
+
+# Vector tiles (MVT)
+
+TILE_CONFIG = {
+    "ciclovia": ("rota_cicloviaria", "nome_lograd AS nome, tipo_rota AS tipo, situacao"),
+    "rodovia": ("faixa_rodagem_rodovia", "id_fx_rod AS id"),
+    "obra_arte": ("logradouro_obra_de_arte", "tipo_obra AS tipo, denominacao AS nome"),
+    "circulacao_viaria": ("rede", "tipo_logradouro AS tipo, logradouro"),
+}
+
+
+def tile_sql(nome, z):
+    tabela, props = TILE_CONFIG[nome]
+    geom = geom_column(z)
+    # O filtro && na coluna pre-calculada usa o indice GIST dela
+    return f"""
+        WITH b AS (SELECT ST_TileEnvelope(%s, %s, %s) AS env)
+        SELECT ST_AsMVT(t, '{nome}', 4096, 'geom') FROM (
+            SELECT ST_AsMVTGeom(ST_Transform(src.{geom}, 3857), b.env, 4096, 64, true) AS geom,
+                   {props}
+            FROM {tabela} src, b
+            WHERE src.{geom} && ST_Transform(b.env, 4326)
+        ) t
+    """
+
+
+_tile_versao = None  # (instante da leitura, versao)
+_tile_lock = threading.Lock()
+
+
+def tile_version():
+    """Versao da rede para o cache de tiles, relida no banco no maximo a cada TILE_VERSION_TTL s.
+
+    Quando a versao muda (ou na primeira leitura), apaga os diretorios de versoes antigas.
+    """
+    global _tile_versao
+    with _tile_lock:
+        atual = _tile_versao
+    if atual is not None and time.monotonic() - atual[0] < TILE_VERSION_TTL:
+        return atual[1]
+    versao = check_network_version() or "sem_versao"
+    with _tile_lock:
+        _tile_versao = (time.monotonic(), versao)
+    if atual is None or atual[1] != versao:
+        if TILE_CACHE_DIR.is_dir():
+            for d in TILE_CACHE_DIR.iterdir():
+                if d.is_dir() and d.name != versao:
+                    shutil.rmtree(d, ignore_errors=True)
+    return versao
+
+
+@app.route("/api/tiles/<nome>/<int:z>/<int:x>/<int:y>.pbf")
+def tile(nome, z, x, y):
+    """Tile MVT da camada, com cache em disco por versao da rede."""
+    if nome not in TILE_CONFIG:
+        return jsonify({"error": f"Camada '{nome}' nao existe"}), 404
+    if not (0 <= z <= 22 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return jsonify({"error": "Tile invalido"}), 400
+
+    try:
+        versao = tile_version()
+        path = TILE_CACHE_DIR / versao / nome / str(z) / str(x) / f"{y}.pbf"
+        if path.exists():
+            data = path.read_bytes()
+        else:
+            with pool.connection() as c:
+                cur = c.cursor()
+                cur.execute(tile_sql(nome, z), (z, x, y), prepare=True)
+                data = bytes(cur.fetchone()[0] or b"")
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+        r = Response(data, mimetype="application/vnd.mapbox-vector-tile")
+        r.headers["Cache-Control"] = "public, max-age=3600"
+        return r
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 SQL_SEGURA = "SELECT id, source, target, cost, reverse_cost FROM rede"
 SQL_RAPIDA = "SELECT id, source, target, GREATEST(comprimento,0.1) AS cost, GREATEST(comprimento,0.1) AS reverse_cost FROM rede"
+SQL_PERFIS = {"segura": SQL_SEGURA, "rapida": SQL_RAPIDA}
+
+
+def compute_route(perfil, start, end, precisao=9):
+    # Perfis de custo montados em tempo de execucao so existem no grafo em memoria.
+    # A busca em memoria roda sem conexao do pool: so fetch_edges usa uma
+    if ENGINE == "memoria" or perfil not in SQL_PERFIS:
+        caminho = get_graph().shortest_path(perfil, start, end, ALGORITHM)
+        if not caminho.arestas:
+            return []
+        with pool.connection() as c:
+            return fetch_edges(c.cursor(), caminho.arestas, precisao, get_graph())
+    with pool.connection() as c:
+        return run_dijkstra(c.cursor(), SQL_PERFIS[perfil], start, end, precisao)
+
+
+def _snap(lat, lng):
+    """(vertice, ilhas por perfil) do ponto; sem ilhas (None) no motor em memoria."""
+    if ENGINE == "memoria":
+        return get_graph().snap(lat, lng, SNAP_FOLGA), None
+    with pool.connection() as c:
+        return find_vertex(c.cursor(), lat, lng)
+
+
+FORMATOS_ROTA = ("geojson", "geojson_precisao", "polyline6")
+
+# Perfis de custo nomeados: os padrao mais os de um JSON opcional {"nome": {parametro: valor}}
+PERFIS_CUSTO = dict(PERFIS_CUSTO)
+
+
+def cost_params(nome, pesos):
+    """Parametros do perfil nomeado com os pesos da requisicao por cima; (params, erro)."""
+    if nome not in PERFIS_CUSTO:
+        return None, f"Perfil de custo invalido; use {', '.join(PERFIS_CUSTO)}"
+    params = dict(CUSTO_PADRAO, **PERFIS_CUSTO[nome])
+    if pesos is None:
+        return params, None
+    if not isinstance(pesos, dict) or set(pesos) - set(CUSTO_PADRAO):
+        return None, f"pesos aceita apenas {', '.join(CUSTO_PADRAO)}"
+    for k, v in pesos.items():
+        if v is None and k.endswith("_ref"):
+            params[k] = None
+        elif isinstance(v, (int, float)) and not isinstance(v, bool) and 0 <= v < float("inf"):
+            params[k] = float(v)
+        else:
+            return None, f"peso {k} deve ser um numero >= 0"
+    return params, None
+
+
+def load_cost_profiles(caminho):
+    """Perfis do JSON validados como os pesos de /api/rota; nao redefine os perfis padrao."""
+    extras = orjson.loads(Path(caminho).read_bytes())
+    if not isinstance(extras, dict):
+        raise ValueError(f"{caminho}: esperado um objeto {{nome: {{parametro: valor}}}}")
+    perfis = {}
+    for nome, pesos in extras.items():
+        if nome in PERFIS_CUSTO:
+            raise ValueError(f"{caminho}: perfil {nome} ja existe e nao pode ser redefinido")
+        if not isinstance(pesos, dict):
+            raise ValueError(f"{caminho}: perfil {nome} deve ser um objeto {{parametro: valor}}")
+        params, erro = cost_params("segura", pesos)
+        if erro:
+            raise ValueError(f"{caminho}: perfil {nome}: {erro}")
+        perfis[nome] = params
+    return perfis
+
+
+if os.getenv("PERFIS_CUSTO_ARQUIVO"):
+    PERFIS_CUSTO.update(load_cost_profiles(os.getenv("PERFIS_CUSTO_ARQUIVO")))
+
+
+@contextmanager
+def cost_profile(params):
+    """Chave do perfil para compute_route dentro do bloco `with`.
+
+    "segura" sem params; os perfis do banco se os pesos baterem; senao um perfil do
+    grafo, que fica nele ate o fim do bloco (as buscas rodam depois, no executor).
+    """
+    if not params:
+        yield "segura"
+        return
+    for perfil in SQL_PERFIS:
+        if params == dict(CUSTO_PADRAO, **PERFIS_CUSTO[perfil]):
+            yield perfil
+            return
+    with get_graph().custom_profile(params) as chave:
+        yield chave
+
+
+def _route(perfil, start, end, formato="geojson", precisao=9):
+    """Rota do perfil no formato pedido (None se nao houver caminho), via cache."""
+    key = (start, end, perfil, formato, precisao)
+    result = route_cache.get(key)
+    if result is None:
+        rows = compute_route(perfil, start, end, precisao)
+        if not rows:
+            return None
+        result = build_polyline(rows) if formato == "polyline6" else build_geojson(rows)
+        route_cache.put(key, result)
+    return result
 
 
 @app.route("/api/rota", methods=["POST", "OPTIONS"])
@@ -266,43 +864,406 @@ def rota():
     except (TypeError, ValueError, IndexError):
         return jsonify({"error": "Coordenadas invalidas"}), 400
 
-    try:
-        c = get_conn()
-        cur = c.cursor()
+    # Formatos compactos opcionais: polyline6 ou GeoJSON com coordenadas arredondadas
+    formato = data.get("formato", "geojson")
+    if formato not in FORMATOS_ROTA:
+        return jsonify({"error": f"Formato invalido; use {', '.join(FORMATOS_ROTA)}"}), 400
+    precisao = 9
+    if formato == "geojson_precisao":
+        try:
+            precisao = int(data.get("precisao", 6))
+        except (TypeError, ValueError):
+            precisao = -1
+        if not 0 <= precisao <= 9:
+            return jsonify({"error": "precisao deve ser um inteiro entre 0 e 9"}), 400
+    elif formato == "polyline6":
+        precisao = 6
 
-        v_start = find_vertex(cur, lat_o, lng_o)
-        v_end = find_vertex(cur, lat_d, lng_d)
+    # Perfil de custo nomeado e/ou pesos por requisicao: substituem os pesos da rota segura
+    params = None
+    if "perfil_custo" in data or "pesos" in data:
+        params, erro = cost_params(data.get("perfil_custo", "segura"), data.get("pesos"))
+        if erro:
+            return jsonify({"error": erro}), 400
 
-        if not v_start or not v_end:
-            return jsonify({"error": "Pontos fora da rede viaria"}), 404
-        if v_start == v_end:
-            return jsonify({"error": "Origem e destino muito proximos"}), 400
+    try:
+        check_network_version()
+        # Perfil dinamico fica no grafo ate as buscas do executor terminarem
+        with cost_profile(params) as perfil_segura:
+            f_start = executor.submit(_snap, lat_o, lng_o)
+            f_end = executor.submit(_snap, lat_d, lng_d)
+            snap_start, snap_end = f_start.result(), f_end.result()
+            v_start, v_end = snap_start[0], snap_end[0]
 
-        rows_segura = run_dijkstra(cur, SQL_SEGURA, v_start, v_end)
-        rows_rapida = run_dijkstra(cur, SQL_RAPIDA, v_start, v_end)
+            if not v_start or not v_end:
+                return jsonify({"error": "Pontos fora da rede viaria"}), 404
+            if v_start == v_end:
+                return jsonify({"error": "Origem e destino muito proximos"}), 400
 
-        cur.close(); c.close()
+            # Pares em ilhas diferentes da rede: rejeitados sem busca
+            sem_caminho = split_components(snap_start, snap_end)
+            if sem_caminho >= set(PERFIS):
+                return jsonify({"error": "Origem e destino em partes desconectadas da rede"}), 404
 
-        if not rows_segura and not rows_rapida:
-            return jsonify({"error": "Rota nao encontrada"}), 404
+            # Perfis montados a partir dos pesos do segura tem os mesmos sentidos removidos
+            f_segura = None if "segura" in sem_caminho else executor.submit(
+                _route, perfil_segura, v_start, v_end, formato, precisao)
+            f_rapida = None if "rapida" in sem_caminho else executor.submit(
+                _route, "rapida", v_start, v_end, formato, precisao)
+            s = f_segura.result() if f_segura else None
+            r = f_rapida.result() if f_rapida else None
+
+            if not s and not r:
+                return jsonify({"error": "Rota nao encontrada"}), 404
 
         result = {}
-        if rows_segura:
-            s = build_geojson(rows_segura)
+        if s:
             result["segura"] = s["rota"]
             result["resumo_segura"] = s["resumo"]
-        if rows_rapida:
-            r = build_geojson(rows_rapida)
+        if r:
             result["rapida"] = r["rota"]
             result["resumo_rapida"] = r["resumo"]
+        if params:
+            result["perfil_custo"] = {"nome": data.get("perfil_custo", "segura"), "pesos": params}
+
+        return jsonify(result)
+
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/perfis")
+def perfis():
+    """Perfis de custo nomeados aceitos em perfil_custo e os parametros padrao."""
+    return jsonify({"padrao": CUSTO_PADRAO,
+                    "perfis": {k: dict(CUSTO_PADRAO, **v) for k, v in PERFIS_CUSTO.items()}})
+
+
+# Rotas em lote (NDJSON)
+
+def snap_points(points):
+    """Vertice mais proximo de cada ponto [lat, lng] numa unica operacao (None fora da rede)."""
+    if not points:
+        return []
+    if ENGINE == "memoria":
+        return [int(v) if v >= 0 else None for v in get_graph().snap_many(points, SNAP_FOLGA)]
+    lats, lngs = [p[0] for p in points], [p[1] for p in points]
+    with pool.connection() as c:
+        cur = c.cursor()
+        cur.execute(f"""
+            SELECT v.id
+            FROM unnest(%s::float8[], %s::float8[]) WITH ORDINALITY AS p(lng, lat, i)
+            LEFT JOIN LATERAL (
+                {snap_sql(f"ST_Transform(ST_SetSRID(ST_MakePoint(p.lng, p.lat), 4326), {SRID})")}
+            ) v ON true
+            ORDER BY p.i
+        """, (lngs, lats))
+        return [r[0] for r in cur.fetchall()]
+
+
+def batch_rows(cur, perfil, combos, precisao=None):
+    """Linhas no formato de run_dijkstra para varios pares (start, end): {par: linhas}.
+
+    Sem precisao a geometria nao e lida (geojson nulo). No pgRouting uma unica
+    chamada com tabela de combinacoes monta o grafo uma vez para todos os pares;
+    no motor em memoria cada origem roda um Dijkstra um-para-muitos.
+    """
+    geo = "ST_AsGeoJSON(r.geom_4326, %s)" if precisao is not None else "NULL::text"
+    attrs = f"""r.logradouro, r.tipo_logradouro, r.comprimento,
+               r.elev_source, r.elev_target,
+               r.eh_rodovia, r.eh_obra_arte, r.eh_ciclovia,
+               r.subida_m, r.descida_m,
+               {geo} AS geojson"""
+    params = (precisao,) if precisao is not None else ()
+    res = {}
+
+    if ENGINE == "memoria":
+        g = get_graph()
+        grupos = {}
+        for st, en in combos:
+            grupos.setdefault(st, []).append(en)
+        pares, seqs, edges = [], [], []
+        chaves = []
+        for st, ends in grupos.items():
+            for en, caminho in g.one_to_many(perfil, st, ends).items():
+                k = len(chaves)
+                chaves.append((st, en))
+                pares += [k] * len(caminho.arestas)
+                seqs += range(1, len(caminho.arestas) + 1)
+                edges += caminho.arestas
+        if not edges:
+            return res
+        cur.execute(f"""
+            SELECT p.par, p.seq, p.edge, {attrs}
+            FROM unnest(%s::int[], %s::int[], %s::int[]) AS p(par, seq, edge)
+            JOIN rede r ON p.edge = r.id
+            ORDER BY p.par, p.seq
+        """, params + (pares, seqs, edges))
+        for row in cur.fetchall():
+            res.setdefault(chaves[row[0]], []).append(row[1:])
+        return res
+
+    starts = ",".join(str(int(st)) for st, _ in combos)
+    ends = ",".join(str(int(en)) for _, en in combos)
+    combinacoes = f"SELECT unnest(ARRAY[{starts}]) AS source, unnest(ARRAY[{ends}]) AS target"
+    cur.execute(f"""
+        SELECT di.start_vid, di.end_vid, di.path_seq, di.edge, {attrs}
+        FROM pgr_dijkstra(%s, %s, directed := true) di
+        JOIN rede r ON di.edge = r.id
+        ORDER BY di.start_vid, di.end_vid, di.path_seq
+    """, params + (SQL_PERFIS[perfil], combinacoes))
+    for row in cur.fetchall():
+        res.setdefault((row[0], row[1]), []).append(row[2:])
+    return res
+
+
+@app.route("/api/rotas/lote", methods=["POST", "OPTIONS"])
+def rotas_lote():
+    """Muitos pares origem-destino de um perfil; uma linha NDJSON por par.
+
+    Corpo: {"pares": [{"origem": [lat, lng], "destino": [lat, lng]}, ...],
+            "perfil": "segura", "geometria": false, "precisao": 6}
+    Cada linha traz "indice" (posicao do par) e "resumo", "rota" (se geometria)
+    ou "error". As linhas saem agrupadas por origem, nao na ordem de entrada.
+    """
+    if request.method == "OPTIONS":
+        return make_response("", 204)
+
+    data = request.get_json(silent=True) or {}
+    pares = data.get("pares")
+    if not isinstance(pares, list) or not pares:
+        return jsonify({"error": "Envie pares: lista de {origem, destino}"}), 400
+    if len(pares) > LOTE_MAX:
+        return jsonify({"error": f"Maximo de {LOTE_MAX} pares por lote"}), 400
+    perfil = data.get("perfil", "segura")
+    if perfil not in SQL_PERFIS:
+        return jsonify({"error": f"Perfil invalido; use {', '.join(SQL_PERFIS)}"}), 400
+    precisao = None
+    if data.get("geometria"):
+        try:
+            precisao = int(data.get("precisao", 6))
+        except (TypeError, ValueError):
+            precisao = -1
+        if not 0 <= precisao <= 9:
+            return jsonify({"error": "precisao deve ser um inteiro entre 0 e 9"}), 400
+
+    try:
+        pontos = []
+        for p in pares:
+            pontos.append((float(p["origem"][0]), float(p["origem"][1])))
+            pontos.append((float(p["destino"][0]), float(p["destino"][1])))
+    except (TypeError, ValueError, IndexError, KeyError):
+        return jsonify({"error": "Coordenadas invalidas"}), 400
+
+    try:
+        check_network_version()
+        vertices = snap_points(pontos)
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+    # Pares repetidos (apos o snapping) sao calculados uma vez so
+    erros, grupos = [], {}
+    for i in range(len(pares)):
+        st, en = vertices[2 * i], vertices[2 * i + 1]
+        if not st or not en:
+            erros.append({"indice": i, "error": "Pontos fora da rede viaria"})
+        elif st == en:
+            erros.append({"indice": i, "error": "Origem e destino muito proximos"})
+        else:
+            grupos.setdefault(st, {}).setdefault(en, []).append(i)
+
+    def generate():
+        for e in erros:
+            yield orjson.dumps(e) + b"\n"
+        origens = list(grupos)
+        with pool.connection() as c:
+            cur = c.cursor()
+            for k in range(0, len(origens), LOTE_ORIGENS):
+                bloco = origens[k:k + LOTE_ORIGENS]
+                combos = [(st, en) for st in bloco for en in grupos[st]]
+                try:
+                    linhas = batch_rows(cur, perfil, combos, precisao)
+                except Exception as e:
+                    traceback.print_exc()
+                    c.rollback()
+                    for st, en in combos:
+                        for i in grupos[st][en]:
+                            yield orjson.dumps({"indice": i, "error": str(e)}) + b"\n"
+                    continue
+                for st, en in combos:
+                    rows = linhas.get((st, en))
+                    if rows:
+                        r = build_geojson(rows)
+                        item = {"resumo": r["resumo"]}
+                        if precisao is not None:
+                            item["rota"] = r["rota"]
+                    else:
+                        item = {"error": "Rota nao encontrada"}
+                    for i in grupos[st][en]:
+                        yield orjson.dumps({"indice": i, **item}) + b"\n"
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+# Matriz origem-destino
+
+def _pontos(lista):
+    return [(float(p[0]), float(p[1])) for p in lista]
+
+
+_matriz_pool = None
+_matriz_lock = threading.Lock()
+
+
+def matriz_pool():
+    """Processos da matriz, criados no primeiro uso (spawn: nao herdam conexoes nem threads)."""
+    global _matriz_pool
+    with _matriz_lock:
+        if _matriz_pool is None:
+            _matriz_pool = ProcessPoolExecutor(max_workers=MATRIZ_PROCESSOS,
+                                               mp_context=multiprocessing.get_context("spawn"))
+    return _matriz_pool
 
+
+def _matriz_perfis(g, origens, destinos):
+    """{perfil: (custo, comp, subida)}; com snapshot, blocos do lado menor vao para os processos."""
+    if g.pasta is None or MATRIZ_PROCESSOS <= 0:
+        return {p: g.matrix(p, origens, destinos) for p in SQL_PERFIS}
+    eixo = 1 if len(destinos) < len(origens) else 0
+    lado = destinos if eixo else origens
+    blocos = np.array_split(lado, min(MATRIZ_PROCESSOS, len(lado)))
+    futuros = {p: [matriz_pool().submit(snapshot_matrix, g.pasta, p,
+                                        *((origens, b) if eixo else (b, destinos)))
+                   for b in blocos]
+               for p in SQL_PERFIS}
+    return {p: tuple(np.concatenate(m, axis=eixo) for m in zip(*(f.result() for f in fs)))
+            for p, fs in futuros.items()}
+
+
+@app.route("/api/matriz", methods=["POST", "OPTIONS"])
+def matriz():
+    """Matrizes N x M de custo, distancia e subida para os perfis segura e rapida.
+
+    Corpo: {"origens": [[lat, lng], ...], "destinos": [[lat, lng], ...]}.
+    Sempre usa o grafo em memoria (many-to-many na CH do perfil quando ela existe,
+    senao uma busca por vertice do lado menor, via scipy.sparse.csgraph), em
+    MATRIZ_PROCESSOS processos quando ha snapshot; null onde nao ha caminho ou o
+    ponto esta fora da rede.
+    """
+    if request.method == "OPTIONS":
+        return make_response("", 204)
+
+    data = request.get_json(silent=True) or {}
+    try:
+        origens, destinos = _pontos(data["origens"]), _pontos(data["destinos"])
+    except (TypeError, ValueError, IndexError, KeyError):
+        return jsonify({"error": "Envie origens e destinos como listas de [lat, lng]"}), 400
+    if not origens or not destinos:
+        return jsonify({"error": "Envie origens e destinos como listas de [lat, lng]"}), 400
+    if len(origens) > MATRIZ_MAX or len(destinos) > MATRIZ_MAX:
+        return jsonify({"error": f"Maximo de {MATRIZ_MAX} origens e {MATRIZ_MAX} destinos"}), 400
+
+    try:
+        check_network_version()
+        g = get_graph()
+        v_orig = g.snap_many(origens, SNAP_FOLGA)
+        v_dest = g.snap_many(destinos, SNAP_FOLGA)
+        result = {
+            "origens": [int(v) if v >= 0 else None for v in v_orig],
+            "destinos": [int(v) if v >= 0 else None for v in v_dest],
+        }
+        for perfil, (custo, comp, subida) in _matriz_perfis(g, v_orig, v_dest).items():
+            result[perfil] = {"custo": np.round(custo, 1), "distancia_m": np.round(comp, 1),
+                              "subida_total_m": np.round(subida, 1)}
         return jsonify(result)
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
+# Alcance (isocrona)
+
+SQL_ALCANCE = """
+    SELECT ST_AsGeoJSON(ST_ConcaveHull(ST_Collect(geom_4326), %s), 6),
+           COALESCE(json_agg(json_build_object(
+               'type', 'Feature',
+               'geometry', ST_AsGeoJSON(geom_4326, 6)::json,
+               'properties', json_build_object('id', id)))
+               FILTER (WHERE %s), '[]')::text
+    FROM rede
+    WHERE id = ANY(%s)
+"""
+
+
+def reach_tree(g, perfil, vertice):
+    """Custos a partir do vertice ate ALCANCE_MAX, guardados para reuso com outro orcamento.
+
+    Guardados em float32 (4 bytes por vertice da rede por arvore em cache): o erro de
+    arredondamento fica muito abaixo da resolucao do orcamento.
+    """
+    key = (vertice, perfil)
+    dist = reach_cache.get(key)
+    if dist is None:
+        dist = g.distances(perfil, vertice, ALCANCE_MAX).astype(np.float32)
+        reach_cache.put(key, dist)
+    return dist
+
+
+@app.route("/api/alcance")
+def alcance():
+    """Arestas alcancaveis a partir de um ponto dentro de um orcamento e a area (concave hull).
+
+    Parametros: lat, lng, perfil (segura|rapida), orcamento (no custo do perfil:
+    metros na rapida, custo com declividade na segura) e arestas=0 para so a area.
+    """
+    try:
+        lat, lng = float(request.args["lat"]), float(request.args["lng"])
+        orcamento = float(request.args["orcamento"])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "Envie lat, lng e orcamento"}), 400
+    perfil = request.args.get("perfil", "segura")
+    if perfil not in SQL_PERFIS:
+        return jsonify({"error": f"Perfil invalido; use {', '.join(SQL_PERFIS)}"}), 400
+    if not 0 < orcamento <= ALCANCE_MAX:
+        return jsonify({"error": f"orcamento deve estar entre 0 e {ALCANCE_MAX:g}"}), 400
+    com_arestas = request.args.get("arestas", "1") != "0"
+
+    try:
+        check_network_version()
+        g = get_graph()
+        vertice = g.snap(lat, lng, SNAP_FOLGA)
+        dist = reach_tree(g, perfil, vertice) if vertice is not None else None
+        if dist is None:
+            return jsonify({"error": "Ponto fora da rede viaria"}), 404
+        arestas = g.reachable_edges(perfil, dist, orcamento)
 
+        area, features = None, "[]"
+        if len(arestas):
+            with pool.connection() as c:
+                cur = c.cursor()
+                cur.execute(SQL_ALCANCE, (ALCANCE_HULL, com_arestas, arestas.tolist()), prepare=True)
+                area, features = cur.fetchone()
+        return jsonify({
+            "vertice": vertice, "perfil": perfil, "orcamento": orcamento,
+            "n_arestas": len(arestas),
+            "area": orjson.Fragment(area) if area else None,
+            "arestas": {"type": "FeatureCollection", "features": orjson.Fragment(features)},
+        })
     except Exception as e:
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
 
 if __name__ == "__main__":
+    open_pool()
+    if ENGINE == "memoria":
+        # Versao lida antes de carregar: a primeira requisicao nao descarta o grafo
+        check_network_version()
+        g = get_graph()
+        print(f"  Rede em memoria: {g.n_vertices} vertices, {g.n_arcs} arcos")
+        if ALGORITHM == "ch":
+            print(f"  CH carregada: {', '.join(sorted(g.ch)) or 'nenhum perfil'}")
     print(f"\n  CicloRota BH | http://localhost:5000\n")
     app.run(host="0.0.0.0", port=5000, debug=True)
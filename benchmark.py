@@ -0,0 +1,91 @@
+"""
+Benchmark de roteamento - CicloRota BH.
+Compara, em pares origem-destino aleatorios, o Dijkstra atual com o A*
+bidirecional, o ALT e a contraction hierarchy (se gravados pelo setup) do motor
+em memoria: vertices visitados, reducao do espaco de busca e latencia por perfil.
+
+Uso: python benchmark.py [--pares 200] [--seed 0] [--sem-pgr]
+"""
+
+import argparse, statistics, time
+import numpy as np
+from app import get_conn, SQL_PERFIS
+from grafo import Graph, PERFIS
+
+
+def log(msg):
+    print(msg, flush=True)
+
+
+def time_pgr(cur, perfil, start, end):
+    escaped = SQL_PERFIS[perfil].replace("'", "''")
+    t = time.perf_counter()
+    cur.execute(f"SELECT COUNT(*) FROM pgr_dijkstra('{escaped}', %s, %s, directed := true)",
+                (start, end))
+    cur.fetchone()
+    return time.perf_counter() - t
+
+
+def run(g, cur, pares, algoritmos):
+    for perfil in PERFIS:
+        log(f"\n  Perfil {perfil} (fator heuristico {g.h_factor[perfil]:.3f})")
+        log(f"  {'algoritmo':<12}{'visitados (med)':>18}{'x Dijkstra':>12}{'ms (med)':>12}{'ms (p95)':>12}")
+        ref, base = {}, {}
+        for alg in algoritmos:
+            visitados, tempos, divergentes = [], [], 0
+            for a, b in pares:
+                if alg == "pgr_dijkstra":
+                    tempos.append(time_pgr(cur, perfil, a, b))
+                    continue
+                t = time.perf_counter()
+                c = g.shortest_path(perfil, a, b, alg)
+                tempos.append(time.perf_counter() - t)
+                visitados.append(c.visitados)
+                base.setdefault((a, b), c.visitados)
+                custo = ref.setdefault((a, b), c.custo)
+                if (custo is None) != (c.custo is None) or (
+                        custo is not None and abs(custo - c.custo) > 1e-6 * max(custo, 1)):
+                    divergentes += 1
+            ms = sorted(1000 * x for x in tempos)
+            vis = f"{statistics.median(visitados):.0f}" if visitados else "-"
+            # Reducao do espaco de busca: mediana por par de visitados(Dijkstra) / visitados
+            red = [base[p] / v for p, v in zip(pares, visitados) if v] if visitados else []
+            red = f"{statistics.median(red):.1f}" if red else "-"
+            log(f"  {alg:<12}{vis:>18}{red:>12}{statistics.median(ms):>12.2f}"
+                f"{ms[int(0.95 * (len(ms) - 1))]:>12.2f}")
+            if divergentes:
+                log(f"    ATENCAO: {divergentes} custos diferentes do Dijkstra")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pares", type=int, default=200)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--sem-pgr", action="store_true", help="nao mede pgr_dijkstra no banco")
+    args = ap.parse_args()
+
+    c = get_conn()
+    cur = c.cursor()
+    t = time.perf_counter()
+    g = Graph.from_db(cur)
+    log(f"\n  Rede: {g.n_vertices} vertices, {g.n_arcs} arcos ({time.perf_counter() - t:.1f}s)")
+
+    rng = np.random.default_rng(args.seed)
+    ids = rng.choice(g.vertex_ids, size=(args.pares, 2))
+    pares = [(int(a), int(b)) for a, b in ids if a != b]
+
+    algoritmos = ["dijkstra", "astar"]
+    if g.load_alt(cur):
+        algoritmos.append("alt")
+    if g.load_ch(cur):
+        algoritmos.append("ch")
+    if not args.sem_pgr:
+        algoritmos.append("pgr_dijkstra")
+    run(g, cur, pares, algoritmos)
+
+    cur.close()
+    c.close()
+
+
+if __name__ == "__main__":
+    main()
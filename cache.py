@@ -0,0 +1,55 @@
+"""
+Cache de rotas - CicloRota BH.
+LRU limitado por tamanho e TTL, invalidado quando a versao da rede muda.
+"""
+
+import threading, time
+from collections import OrderedDict
+
+
+class RouteCache:
+    """Guarda a saida de build_geojson por (v_start, v_end, perfil); tambem as arvores do alcance."""
+
+    def __init__(self, maxsize=1024, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set_version(self, version):
+        """Descarta tudo se a rede foi reimportada; retorna True nesse caso."""
+        with self._lock:
+            if version == self.version:
+                return False
+            self.version = version
+            self._data.clear()
+            return True
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and time.monotonic() - item[0] <= self.ttl:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"tamanho": len(self._data), "max": self.maxsize, "ttl_s": self.ttl,
+                    "hits": self.hits, "misses": self.misses, "versao_rede": self.version}
@@ -0,0 +1,1286 @@
+"""
+Motor de roteamento em memoria - CicloRota BH.
+Carrega a tabela rede uma unica vez em arrays CSR (NumPy) e calcula as rotas
+segura e rapida no proprio processo, sem reconstruir o grafo no banco.
+"""
+
+import hashlib, heapq, json, math, threading
+from collections import namedtuple
+from contextlib import contextmanager
+from pathlib import Path
+import numpy as np
+from pyproj import Transformer
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, dijkstra as sp_dijkstra
+from scipy.spatial import cKDTree
+
+SRID = 31983
+INF = float("inf")
+
+SQL_REDE = """
+    SELECT id, source, target, cost, reverse_cost, comprimento, elev_source, elev_target,
+           eh_rodovia, eh_obra_arte, eh_ciclovia, subida_m, descida_m
+    FROM rede
+    WHERE source IS NOT NULL AND target IS NOT NULL
+    ORDER BY id
+"""
+
+SQL_VERTICES = "SELECT id, ST_X(geom), ST_Y(geom) FROM rede_vertices_pgr"
+
+PERFIS = ("segura", "rapida")
+
+# Parametros da funcao de custo (calculate_costs no setup usa os mesmos):
+# subida: 1 + (inclinacao% / subida_ref)^2; descida: max(descida_min, 1 - inclinacao% / descida_ref);
+# multiplicadores por tipo de trecho. Referencia nula desliga o efeito da inclinacao.
+CUSTO_PADRAO = {"subida_ref": 8.0, "descida_ref": 25.0, "descida_min": 0.4,
+                "rodovia": 100.0, "obra_arte": 50.0, "ciclovia": 0.0}
+PERFIS_CUSTO = {
+    "segura": CUSTO_PADRAO,
+    "rapida": {"subida_ref": None, "descida_ref": None, "descida_min": 0.4,
+               "rodovia": 1.0, "obra_arte": 1.0, "ciclovia": 1.0},
+}
+# Perfis de custo montados em tempo de execucao mantidos por grafo (arrays de pesos sao grandes)
+PERFIS_DINAMICOS_MAX = 8
+
+# Candidatos (vizinhos mais proximos) avaliados no snapping que prefere a componente principal
+SNAP_VIZINHOS = 8
+
+# ALT: landmarks por perfil e quantos deles (os de melhor limite para o par) cada busca usa
+ALT_LANDMARKS = 16
+ALT_ATIVOS = 4
+
+# Limite de vertices fixados em cada busca de testemunha da contracao e, menor, nas
+# que so estimam a prioridade (um atalho a mais na estimativa nao cria atalho na CH)
+CH_WITNESS_LIMIT = 500
+CH_ESTIMATIVA_LIMIT = 30
+
+Caminho = namedtuple("Caminho", "arestas custo visitados")
+
+# Snapshot binario do grafo (um .npy por array, aberto com mmap): versao do formato e arrays
+SNAPSHOT_FORMATO = 5
+SNAPSHOT_ARRAYS = ("vertex_ids", "offsets", "tail", "head", "edge", "comprimento", "subida",
+                   "inclinacao", "rev_arcs", "rev_offsets", "x", "y", "elevacao")
+# Arrays de cada Hierarchy (CH) gravada no snapshot
+SNAPSHOT_CH = ("rank", "tail", "head", "weight", "edge", "child1", "child2")
+# Tabela de logradouros por aresta: codigos numa tabela de textos sem repeticao
+SNAPSHOT_NOMES = ("aresta_id", "aresta_logradouro", "aresta_tipo", "texto_offsets", "texto_blob")
+# Matriz esparsa de cada perfil (Graph._sparse) gravada no snapshot
+SNAPSHOT_CSR = ("indptr", "indices", "data", "chaves", "arcos")
+
+# lng/lat (4326) -> coordenadas metricas da rede
+_to_utm = Transformer.from_crs(4326, SRID, always_xy=True)
+
+
+class Graph:
+    """Grafo direcionado em CSR: cada aresta da rede gera um arco em cada sentido."""
+
+    def __init__(self, edge_id, source, target, cost, reverse_cost, comprimento,
+                 elev_source=None, elev_target=None, rodovia=None, obra_arte=None, ciclovia=None,
+                 subida=None, descida=None):
+        self.vertex_ids = np.unique(np.concatenate([source, target]))
+        n = len(self.vertex_ids)
+        src = np.searchsorted(self.vertex_ids, source)
+        tgt = np.searchsorted(self.vertex_ids, target)
+
+        # Arco direto (source -> target) usa cost, arco reverso usa reverse_cost
+        tail = np.concatenate([src, tgt])
+        head = np.concatenate([tgt, src])
+        rapida = np.maximum(comprimento, 0.1)
+        pesos = {
+            "segura": np.concatenate([cost, reverse_cost]),
+            "rapida": np.concatenate([rapida, rapida]),
+        }
+
+        order = np.argsort(tail, kind="stable")
+        self.offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(tail, minlength=n), out=self.offsets[1:])
+        self.tail = tail[order]
+        self.head = head[order]
+        self.edge = np.concatenate([edge_id, edge_id])[order]
+        # Atributos por arco para as matrizes: comprimento e subida no sentido do arco
+        comp = np.nan_to_num(np.asarray(comprimento, dtype=np.float64))
+        self.comprimento = np.concatenate([comp, comp])[order]
+        # Elevacao de cada vertice pelas pontas das arestas (0 sem elevacao, como em rede)
+        self.elevacao = np.zeros(n)
+        if elev_source is None or elev_target is None:
+            self.subida = np.zeros(len(tail))
+            self.inclinacao = np.full(len(tail), np.nan)
+        else:
+            es = np.asarray(elev_source, dtype=np.float64)
+            et = np.asarray(elev_target, dtype=np.float64)
+            self.elevacao[src] = np.nan_to_num(es)
+            self.elevacao[tgt] = np.nan_to_num(et)
+            dz = np.nan_to_num(et - es)
+            sobe, desce = np.maximum(dz, 0), np.maximum(-dz, 0)
+            # Subida/descida amostradas ao longo da aresta (setup); sem elas, so o desnivel
+            # entre as pontas. O saldo amostrado e o mesmo desnivel, entao a inclinacao
+            # (e o custo) continuam pelas pontas.
+            if subida is not None and descida is not None:
+                sub = np.asarray(subida, dtype=np.float64)
+                desc = np.asarray(descida, dtype=np.float64)
+                sobe = np.where(np.isnan(sub), sobe, sub)
+                desce = np.where(np.isnan(desc), desce, desc)
+            self.subida = np.concatenate([sobe, desce])[order]
+            # Inclinacao (%) no sentido do arco; nan onde calculate_costs ignora a elevacao
+            valido = (es > 0) & (et > 0) & (comp > 0)
+            incl = np.where(valido, dz / np.where(valido, comp, 1) * 100.0, np.nan)
+            self.inclinacao = np.concatenate([incl, -incl])[order]
+        # Flags por arco (features da funcao de custo em tempo de execucao)
+        self.flags = {}
+        for nome, f in (("rodovia", rodovia), ("obra_arte", obra_arte), ("ciclovia", ciclovia)):
+            f = np.zeros(len(edge_id), dtype=bool) if f is None else np.asarray(f) == 1
+            self.flags[nome] = np.concatenate([f, f])[order]
+        self.weights = {}
+        for perfil, w in pesos.items():
+            w = w[order].astype(np.float64)
+            # Como no pgRouting, custo negativo (ou nulo) remove o sentido
+            w[~(w >= 0)] = np.inf
+            self.weights[perfil] = w
+
+        # CSR reverso (arcos de entrada por vertice) para a busca bidirecional
+        self.rev_arcs = np.argsort(self.head, kind="stable")
+        self.rev_offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.head, minlength=n), out=self.rev_offsets[1:])
+
+        # Sem coordenadas a heuristica do A* e nula (equivale a Dijkstra bidirecional)
+        self.x = np.full(n, np.nan)
+        self.y = np.full(n, np.nan)
+        self.h_factor = dict.fromkeys(self.weights, 0.0)
+
+        self._init_state()
+        self.versao = None
+        self.pasta = None
+
+    def _init_state(self):
+        # KD-tree do snapping e matrizes esparsas dos perfis sao montadas no primeiro uso
+        self._tree = None
+        self._csgraph = {}
+        self._comp = {}
+        self._ilhas = {}
+        self._dinamicos = []
+        # Perfis dinamicos em uso por alguma requisicao (custom_profile): nao saem do grafo
+        self._em_uso = {}
+        self._perfis_lock = threading.Lock()
+        self.ch = {}
+        self.landmarks = {}
+        self._nomes = None
+
+    @classmethod
+    def from_db(cls, cur):
+        cur.execute(SQL_REDE)
+        arr = np.array(cur.fetchall(), dtype=np.float64).reshape(-1, 13)
+        ids = arr[:, :3].astype(np.int64)
+        g = cls(ids[:, 0], ids[:, 1], ids[:, 2], *arr[:, 3:].T)
+        cur.execute(SQL_VERTICES)
+        v = np.array(cur.fetchall(), dtype=np.float64).reshape(-1, 3)
+        g.set_coords(v[:, 0].astype(np.int64), v[:, 1], v[:, 2])
+        return g
+
+    def set_coords(self, vid, x, y):
+        """Coordenadas metricas (SRID 31983) dos vertices, para a heuristica do A*.
+
+        O limite inferior e fator * distancia euclidiana, com fator = menor razao
+        peso / corda entre os arcos. Assim a heuristica continua admissivel (e
+        consistente) com descidas a 0.4x e ciclovias a custo 0 no perfil segura;
+        nesse caso extremo o fator e 0 e a busca vira Dijkstra bidirecional.
+        """
+        i = np.searchsorted(self.vertex_ids, vid).clip(0, max(self.n_vertices - 1, 0))
+        ok = self.vertex_ids[i] == vid
+        self.x[i[ok]] = x[ok]
+        self.y[i[ok]] = y[ok]
+        for nome in ("_x", "_y"):
+            self.__dict__.pop(nome, None)
+        self._tree = None
+        for perfil in self.weights:
+            self._set_h_factor(perfil)
+
+    def _set_h_factor(self, perfil):
+        w = self.weights[perfil]
+        chord = np.hypot(self.x[self.head] - self.x[self.tail],
+                         self.y[self.head] - self.y[self.tail])
+        m = np.isfinite(w) & (chord > 0)
+        if np.isnan(self.x).any() or not m.any():
+            self.h_factor[perfil] = 0.0
+        else:
+            self.h_factor[perfil] = float(np.min(w[m] / chord[m]))
+
+    def cost_weights(self, params):
+        """Pesos por arco da funcao de custo de calculate_costs com outros parametros.
+
+        Vetorizado sobre as features ja carregadas (comprimento, inclinacao, flags);
+        sentidos removidos na rede (custo negativo) continuam removidos.
+        """
+        p = dict(CUSTO_PADRAO, **params)
+        incl = self.inclinacao
+        tem = ~np.isnan(incl)
+        fator = np.ones(len(incl))
+        if p["subida_ref"]:
+            up = tem & (incl > 0)
+            fator[up] = 1.0 + (incl[up] / p["subida_ref"]) ** 2
+        if p["descida_ref"]:
+            down = tem & (incl <= 0)
+            fator[down] = np.maximum(p["descida_min"], 1.0 + incl[down] / p["descida_ref"])
+        w = np.maximum(self.comprimento, 0.1) * fator
+        for nome, f in self.flags.items():
+            w[f] *= p[nome]
+        w[~np.isfinite(self.weights["segura"])] = np.inf
+        return w
+
+    @contextmanager
+    def custom_profile(self, params):
+        """Registra um perfil de custo montado em tempo de execucao, mantido ate o fim do `with`.
+
+        As buscas de uma requisicao rodam depois, em outras threads; sem isso, perfis
+        novos de outras requisicoes poderiam tirar este do grafo antes delas.
+        """
+        with self._perfis_lock:
+            chave = self._register_profile(params)
+            self._em_uso[chave] = self._em_uso.get(chave, 0) + 1
+            self._evict_profiles()
+        try:
+            yield chave
+        finally:
+            with self._perfis_lock:
+                self._em_uso[chave] -= 1
+                if not self._em_uso[chave]:
+                    del self._em_uso[chave]
+                self._evict_profiles()
+
+    def _register_profile(self, params):
+        p = dict(CUSTO_PADRAO, **params)
+        chave = "custo:" + ",".join(f"{k}={p[k]}" for k in sorted(p))
+        if chave not in self.weights:
+            self.weights[chave] = self.cost_weights(p)
+            self._set_h_factor(chave)
+            self._dinamicos.append(chave)
+        return chave
+
+    def _evict_profiles(self):
+        # Mais antigos primeiro, pulando os em uso (o limite pode passar enquanto durarem)
+        livres = [k for k in self._dinamicos if k not in self._em_uso]
+        for velho in livres[:max(0, len(self._dinamicos) - PERFIS_DINAMICOS_MAX)]:
+            self._dinamicos.remove(velho)
+            for d in (self.weights, self.h_factor, self._csgraph, self._comp, self._ilhas):
+                d.pop(velho, None)
+
+    def set_names(self, edge_id, logradouro, tipo):
+        """Logradouro e tipo por aresta, numa tabela de textos sem repeticao."""
+        textos, codigos = np.unique(np.array([t or "" for t in (*logradouro, *tipo)], dtype=object),
+                                    return_inverse=True)
+        blob = [t.encode() for t in textos]
+        offsets = np.zeros(len(blob) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in blob], out=offsets[1:])
+        codigos = codigos.astype(np.int32).reshape(2, -1)
+        ordem = np.argsort(edge_id, kind="stable")
+        self._nomes = dict(zip(SNAPSHOT_NOMES, (
+            np.asarray(edge_id, dtype=np.int64)[ordem], codigos[0][ordem], codigos[1][ordem],
+            offsets, np.frombuffer(b"".join(blob), dtype=np.uint8))))
+
+    @property
+    def has_names(self):
+        return self._nomes is not None
+
+    def names(self, edge_ids):
+        """[(logradouro, tipo_logradouro)] das arestas; (None, None) fora da tabela."""
+        n = self._nomes
+        ids = np.asarray(edge_ids, dtype=np.int64).reshape(-1)
+        if not len(n["aresta_id"]):
+            return [(None, None)] * len(ids)
+        i = np.searchsorted(n["aresta_id"], ids).clip(0, len(n["aresta_id"]) - 1)
+        ok = n["aresta_id"][i] == ids
+        off, blob = n["texto_offsets"], n["texto_blob"]
+        logr, tipo = n["aresta_logradouro"][i].tolist(), n["aresta_tipo"][i].tolist()
+
+        def texto(k):
+            return bytes(blob[off[k]:off[k + 1]]).decode() or None
+
+        return [(texto(a), texto(b)) if o else (None, None)
+                for a, b, o in zip(logr, tipo, ok.tolist())]
+
+    def elevations(self, vids):
+        """Elevacao dos vertices de ids `vids` (None fora da rede)."""
+        i = self.indices(vids)
+        return [e if k >= 0 else None for e, k in zip(self.elevacao[i].tolist(), i.tolist())]
+
+    def save(self, pasta, versao):
+        """Grava o snapshot do grafo (arrays .npy + manifest.json) para abrir com Graph.open."""
+        pasta = Path(pasta)
+        pasta.mkdir(parents=True, exist_ok=True)
+        for nome in SNAPSHOT_ARRAYS:
+            np.save(pasta / f"{nome}.npy", np.ascontiguousarray(getattr(self, nome)))
+        for perfil in PERFIS:
+            np.save(pasta / f"peso_{perfil}.npy", self.weights[perfil])
+        for nome, f in self.flags.items():
+            np.save(pasta / f"flag_{nome}.npy", f)
+        for perfil in PERFIS:
+            np.save(pasta / f"comp_{perfil}.npy", self.components(perfil))
+            np.save(pasta / f"ilha_{perfil}.npy", self.islands(perfil))
+        for perfil, lm in self.landmarks.items():
+            for nome in ("vertices", "de", "para"):
+                np.save(pasta / f"alt_{perfil}_{nome}.npy", getattr(lm, nome))
+        for perfil in PERFIS:
+            mat, chaves, arcos = self._sparse(perfil)
+            for nome, arr in zip(SNAPSHOT_CSR, (mat.indptr, mat.indices, mat.data, chaves, arcos)):
+                np.save(pasta / f"csr_{perfil}_{nome}.npy", arr)
+        for perfil, h in self.ch.items():
+            for nome in SNAPSHOT_CH:
+                np.save(pasta / f"ch_{perfil}_{nome}.npy", getattr(h, nome))
+        for nome, arr in (self._nomes or {}).items():
+            np.save(pasta / f"{nome}.npy", arr)
+        manifest = {"formato": SNAPSHOT_FORMATO, "versao": versao,
+                    "vertices": self.n_vertices, "arcos": self.n_arcs,
+                    "perfis": list(PERFIS), "flags": list(self.flags),
+                    "h_factor": {p: self.h_factor[p] for p in PERFIS},
+                    "alt": sorted(self.landmarks), "ch": sorted(self.ch),
+                    "nomes": self.has_names}
+        (pasta / "manifest.json").write_text(json.dumps(manifest, indent=1))
+
+    @classmethod
+    def open(cls, pasta):
+        """Abre um snapshot gravado por save com np.load(mmap_mode="r").
+
+        Nada e copiado: os processos que abrem o mesmo snapshot dividem as paginas
+        do cache do sistema, e a abertura nao depende do tamanho da rede. As buscas
+        leem esses arrays direto (scipy.csgraph ou memoryview).
+        """
+        pasta = Path(pasta)
+        manifest = json.loads((pasta / "manifest.json").read_text())
+        if manifest["formato"] != SNAPSHOT_FORMATO:
+            raise ValueError(f"Formato de snapshot {manifest['formato']} nao suportado")
+
+        def load(nome):
+            # ndarray sobre o buffer do mmap: fatiar um np.memmap e bem mais lento
+            return np.asarray(np.load(pasta / f"{nome}.npy", mmap_mode="r"))
+
+        g = cls.__new__(cls)
+        for nome in SNAPSHOT_ARRAYS:
+            setattr(g, nome, load(nome))
+        g.weights = {p: load(f"peso_{p}") for p in manifest["perfis"]}
+        g.flags = {f: load(f"flag_{f}") for f in manifest["flags"]}
+        g.h_factor = dict(manifest["h_factor"])
+        g._init_state()
+        g._comp = {p: load(f"comp_{p}") for p in manifest["perfis"]}
+        g._ilhas = {p: load(f"ilha_{p}") for p in manifest["perfis"]}
+        g.landmarks = {p: Landmarks(*(load(f"alt_{p}_{nome}") for nome in ("vertices", "de", "para")))
+                       for p in manifest.get("alt", [])}
+        n = len(g.vertex_ids)
+        for p in manifest["perfis"]:
+            indptr, indices, data, chaves, arcos = (load(f"csr_{p}_{nome}") for nome in SNAPSHOT_CSR)
+            g._csgraph[p] = (csr_matrix((data, indices, indptr), shape=(n, n), copy=False),
+                             chaves, arcos)
+        g.ch = {p: Hierarchy(*(load(f"ch_{p}_{nome}") for nome in SNAPSHOT_CH))
+                for p in manifest["ch"]}
+        if manifest["nomes"]:
+            g._nomes = {nome: load(nome) for nome in SNAPSHOT_NOMES}
+        g.versao = manifest["versao"]
+        g.pasta = str(pasta)
+        return g
+
+    @property
+    def n_vertices(self):
+        return len(self.vertex_ids)
+
+    @property
+    def n_arcs(self):
+        return len(self.head)
+
+    def _labels(self, perfil, connection):
+        # Rotulos de connected_components renumerados por tamanho decrescente (0 = a maior)
+        n = self.n_vertices
+        arcs = np.flatnonzero(np.isfinite(self.weights[perfil]))
+        mat = csr_matrix((np.ones(len(arcs), dtype=np.int8), (self.tail[arcs], self.head[arcs])),
+                         shape=(n, n))
+        _, rotulo = connected_components(mat, directed=True, connection=connection)
+        ordem = np.argsort(-np.bincount(rotulo), kind="stable")
+        novo = np.empty_like(ordem)
+        novo[ordem] = np.arange(len(ordem))
+        return novo[rotulo].astype(np.int32)
+
+    def components(self, perfil):
+        """Componente fortemente conexa de cada vertice no perfil (0 = a maior)."""
+        c = self._comp.get(perfil)
+        if c is None:
+            c = self._comp[perfil] = self._labels(perfil, "strong")
+        return c
+
+    def islands(self, perfil):
+        """Componente fracamente conexa (ilha) de cada vertice no perfil (0 = a maior)."""
+        c = self._ilhas.get(perfil)
+        if c is None:
+            c = self._ilhas[perfil] = self._labels(perfil, "weak")
+        return c
+
+    def same_component(self, perfil, start, end):
+        """False se nao ha caminho possivel de start a end no perfil (ilhas diferentes).
+
+        Usa as componentes fracas: entre componentes fortes diferentes ainda pode haver
+        caminho num sentido so (uma mao unica que sai da componente principal, por exemplo).
+        """
+        s, t = self.index(start), self.index(end)
+        if s is None or t is None:
+            return False
+        c = self.islands(perfil)
+        return bool(c[s] == c[t])
+
+    def snap_many(self, points, folga=None):
+        """Vertices mais proximos de varios pontos [lat, lng] numa so chamada vetorizada.
+
+        Com `folga` (m), prefere o vertice mais proximo que esteja na componente principal
+        de todos os perfis, se ele estiver a ate `folga` alem do mais proximo entre os
+        SNAP_VIZINHOS candidatos; ilhas da rede so recebem pontos claramente sobre elas.
+        """
+        pts = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if self._tree is None:
+            # KD-tree para o snapping em memoria (substitui o KNN no banco)
+            valid = ~np.isnan(self.x)
+            self._tree = cKDTree(np.column_stack([self.x[valid], self.y[valid]]))
+            self._tree_idx = np.flatnonzero(valid)
+        if self._tree.n == 0:
+            return np.full(len(pts), -1, dtype=np.int64)
+        x, y = _to_utm.transform(pts[:, 1], pts[:, 0])
+        xy = np.column_stack([x, y])
+        if folga is None:
+            _, i = self._tree.query(xy)
+            return self.vertex_ids[self._tree_idx[i]]
+        d, i = self._tree.query(xy, k=min(SNAP_VIZINHOS, self._tree.n))
+        d, i = d.reshape(len(pts), -1), i.reshape(len(pts), -1)
+        v = self._tree_idx[i]
+        principal = np.logical_and.reduce([self.components(p)[v] == 0 for p in PERFIS])
+        ok = principal & (d <= d[:, :1] + folga)
+        escolha = np.where(ok.any(axis=1), ok.argmax(axis=1), 0)
+        return self.vertex_ids[v[np.arange(len(pts)), escolha]]
+
+    def snap(self, lat, lng, folga=None):
+        """Vertice mais proximo de (lat, lng), como find_vertex; None sem coordenadas."""
+        vid = int(self.snap_many([(lat, lng)], folga)[0])
+        return vid if vid >= 0 else None
+
+    def signature(self, perfil):
+        """Assinatura da topologia + pesos; identifica a CH que vale para a rede atual."""
+        h = hashlib.sha1()
+        for arr in (self.vertex_ids, self.edge, self.weights[perfil]):
+            h.update(np.ascontiguousarray(arr).tobytes())
+        return h.hexdigest()
+
+    def load_ch(self, cur):
+        """Carrega as CHs gravadas pelo setup cuja assinatura confere com os pesos atuais."""
+        cur.execute("SELECT to_regclass('ch_meta')")
+        if cur.fetchone()[0] is None:
+            return []
+        cur.execute("SELECT perfil, assinatura FROM ch_meta")
+        for perfil, assinatura in cur.fetchall():
+            if perfil in self.weights and assinatura == self.signature(perfil):
+                self.ch[perfil] = Hierarchy.from_db(cur, self, perfil)
+        return sorted(self.ch)
+
+    def load_alt(self, cur):
+        """Carrega os landmarks do ALT gravados pelo setup cuja assinatura confere com os pesos."""
+        cur.execute("SELECT to_regclass('alt_meta')")
+        if cur.fetchone()[0] is None:
+            return []
+        cur.execute("SELECT perfil, assinatura FROM alt_meta")
+        for perfil, assinatura in cur.fetchall():
+            if perfil in self.weights and assinatura == self.signature(perfil):
+                self.landmarks[perfil] = Landmarks.from_db(cur, self, perfil)
+        return sorted(self.landmarks)
+
+    def index(self, vid):
+        """Indice interno do vertice de id `vid` (rede_vertices_pgr.id), ou None."""
+        i = int(np.searchsorted(self.vertex_ids, vid))
+        if i < len(self.vertex_ids) and self.vertex_ids[i] == vid:
+            return i
+        return None
+
+    def indices(self, vids):
+        """Indices internos de varios ids de vertice (-1 para ids fora da rede)."""
+        vids = np.asarray(vids, dtype=np.int64).reshape(-1)
+        i = np.searchsorted(self.vertex_ids, vids).clip(0, max(self.n_vertices - 1, 0))
+        return np.where(self.vertex_ids[i] == vids, i, -1)
+
+    def shortest_path(self, perfil, start, end, algoritmo="dijkstra"):
+        # Ilhas diferentes: sem caminho, sem busca
+        if start != end and not self.same_component(perfil, start, end):
+            return Caminho([], None, 0)
+        if algoritmo == "ch":
+            h = self.ch.get(perfil)
+            if h is not None:
+                s, t = self.index(start), self.index(end)
+                if s is None or t is None:
+                    return Caminho([], None, 0)
+                return h.query(s, t)
+            # Sem CH valida para os pesos atuais: melhor busca disponivel
+            algoritmo = "astar"
+        if algoritmo == "alt":
+            return self.alt(perfil, start, end)
+        if algoritmo == "astar":
+            return self.astar(perfil, start, end)
+        return self.dijkstra(perfil, start, end)
+
+    def _unpack(self, pred, s, t):
+        """Arcos de s a t pelos predecessores das buscas em Python (vertice -> arco)."""
+        tail = memoryview(self.tail)
+        arcs = []
+        v = t
+        while v != s:
+            a = pred[v]
+            arcs.append(a)
+            v = tail[a]
+        arcs.reverse()
+        return arcs
+
+    def _tree_edges(self, perfil, pred, s, t):
+        """Ids das arestas de s a t na arvore de predecessores (vertice -> vertice) do scipy."""
+        caminho = [t]
+        v = t
+        while v != s:
+            v = int(pred[v])
+            caminho.append(v)
+        caminho = np.array(caminho[::-1], dtype=np.int64)
+        _, keys, arcs = self._sparse(perfil)
+        chave = caminho[:-1] * self.n_vertices + caminho[1:]
+        return self.edge[arcs[np.searchsorted(keys, chave)]].tolist()
+
+    def dijkstra(self, perfil, start, end):
+        """Menor caminho entre dois vertices da rede; arestas vazias se nao houver.
+
+        A busca e a do scipy.csgraph (compilada) sobre a matriz esparsa do perfil;
+        `visitados` conta os vertices que um Dijkstra parando no destino fixaria.
+        """
+        s, t = self.index(start), self.index(end)
+        if s is None or t is None:
+            return Caminho([], None, 0)
+
+        dist, pred = sp_dijkstra(self._sparse(perfil)[0], indices=s, return_predecessors=True)
+        if not np.isfinite(dist[t]):
+            return Caminho([], None, int(np.isfinite(dist).sum()))
+        return Caminho(self._tree_edges(perfil, pred, s, t), float(dist[t]),
+                       int(np.count_nonzero(dist <= dist[t])))
+
+    def one_to_many(self, perfil, start, ends):
+        """Um unico Dijkstra (scipy.csgraph) de `start` ate todos os `ends`; {end: Caminho}."""
+        s = self.index(start)
+        idx = {e: self.index(e) for e in set(ends)}
+        if s is None:
+            return {e: Caminho([], None, 0) for e in idx}
+
+        dist, pred = sp_dijkstra(self._sparse(perfil)[0], indices=s, return_predecessors=True)
+        alcancados = [t for t in idx.values() if t is not None and np.isfinite(dist[t])]
+        visitados = int(np.count_nonzero(dist <= max(dist[t] for t in alcancados))) if alcancados else 0
+        res = {}
+        for e, t in idx.items():
+            if t is None or not np.isfinite(dist[t]):
+                res[e] = Caminho([], None, visitados)
+            else:
+                res[e] = Caminho(self._tree_edges(perfil, pred, s, t), float(dist[t]), visitados)
+        return res
+
+    def _sparse(self, perfil):
+        """Matriz esparsa (scipy.csgraph) do perfil, com arcos paralelos reduzidos ao menor peso.
+
+        Retorna (matriz, chaves, arcos): chaves = tail * n + head ordenadas e o
+        arco escolhido para cada uma, para recuperar atributos pelo predecessor.
+        """
+        m = self._csgraph.get(perfil)
+        if m is None:
+            n = self.n_vertices
+            w = self.weights[perfil]
+            arcs = np.flatnonzero(np.isfinite(w))
+            keys = self.tail[arcs] * n + self.head[arcs]
+            order = np.lexsort((w[arcs], keys))
+            arcs, keys = arcs[order], keys[order]
+            first = np.ones(len(keys), dtype=bool)
+            first[1:] = keys[1:] != keys[:-1]
+            arcs, keys = arcs[first], keys[first]
+            # Zeros explicitos (ciclovia no perfil segura) continuam sendo arcos
+            mat = csr_matrix((w[arcs], (self.tail[arcs], self.head[arcs])), shape=(n, n))
+            m = self._csgraph[perfil] = (mat, keys, arcs)
+        return m
+
+    def matrix(self, perfil, sources, targets, lote=16):
+        """Custo, comprimento e subida do menor caminho (pelo custo) de cada origem a cada destino.
+
+        Com CH do perfil, many-to-many na hierarquia (Hierarchy.matrix). Sem ela, uma
+        busca por vertice do lado menor (origens, ou destinos no grafo transposto), e
+        comprimento e subida sao somados subindo a arvore de predecessores so a partir
+        dos vertices do outro lado, todos juntos a cada passo. Retorna tres arrays
+        (N x M), inf sem caminho.
+        """
+        src, tgt = self.indices(sources), self.indices(targets)
+        shape = (len(src), len(tgt))
+        custo, comp, subida = np.full(shape, np.inf), np.full(shape, np.inf), np.full(shape, np.inf)
+        if not len(src) or not len(tgt):
+            return custo, comp, subida
+        if perfil in self.ch:
+            return self.ch[perfil].matrix(self, src, tgt)
+
+        mat, keys, arcs = self._sparse(perfil)
+        n = self.n_vertices
+        reverso = len(tgt) < len(src)
+        raiz, outro = (tgt, src) if reverso else (src, tgt)
+        if reverso:
+            mat = mat.T.tocsr()
+        ok_raiz, ok_outro = np.flatnonzero(raiz >= 0), outro >= 0
+        col = np.where(ok_outro, outro, 0)
+        vert = np.arange(n)
+
+        for k in range(0, len(ok_raiz), lote):
+            linhas = ok_raiz[k:k + lote]
+            dist, pred = sp_dijkstra(mat, indices=raiz[linhas], return_predecessors=True)
+            # Comprimento e subida do arco de chegada em cada vertice da arvore, em
+            # arrays planos (uma arvore por linha). Raiz e inalcancaveis apontam para si
+            # mesmos com atributo 0, entao subir alem deles nao muda a soma
+            pred = pred.astype(np.int64)  # a chave tail * n + head nao cabe em int32
+            tem = pred >= 0
+            a, b = (vert, pred) if reverso else (pred, vert)
+            arco = arcs[np.searchsorted(keys, np.where(tem, a * n + b, 0)).clip(0, len(keys) - 1)]
+            arco_c = np.where(tem, self.comprimento[arco], 0.0).ravel()
+            arco_s = np.where(tem, self.subida[arco], 0.0).ravel()
+            base = (np.arange(len(linhas)) * n)[:, None]
+            anc = (np.where(tem, pred, vert) + base).ravel()
+
+            # Sobe so a partir das celulas (linha, destino), um arco por passo
+            d = np.where(ok_outro, dist[:, col], np.inf)
+            v = (base + col).ravel()
+            c, s = np.zeros(len(v)), np.zeros(len(v))
+            while True:
+                for _ in range(8):
+                    c += arco_c[v]
+                    s += arco_s[v]
+                    v = anc[v]
+                if (anc[v] == v).all():
+                    break
+            c, s = c.reshape(d.shape), s.reshape(d.shape)
+
+            fora = ~np.isfinite(d)
+            c[fora] = np.inf
+            s[fora] = np.inf
+            if reverso:
+                custo[:, linhas], comp[:, linhas], subida[:, linhas] = d.T, c.T, s.T
+            else:
+                custo[linhas], comp[linhas], subida[linhas] = d, c, s
+        return custo, comp, subida
+
+    def distances(self, perfil, start, limite=INF):
+        """Custo minimo de `start` a todos os vertices; busca para em `limite` (inf alem dele)."""
+        s = self.index(start)
+        if s is None:
+            return None
+        return sp_dijkstra(self._sparse(perfil)[0], indices=s, limit=limite)
+
+    def reachable_edges(self, perfil, dist, orcamento):
+        """Ids das arestas percorridas por inteiro com custo acumulado <= orcamento."""
+        ok = dist[self.tail] + self.weights[perfil] <= orcamento
+        return np.unique(self.edge[ok])
+
+    def astar(self, perfil, start, end):
+        """A* bidirecional com potenciais medios (p = (h_t - h_s) / 2).
+
+        Os custos reduzidos sao iguais nos dois sentidos e nao negativos, entao
+        a busca pode parar quando topo_direto + topo_reverso >= melhor caminho.
+        Os lacos leem os arrays do grafo (mmap no snapshot) por memoryview, sem copias.
+        """
+        s, t = self.index(start), self.index(end)
+        if s is None or t is None:
+            return Caminho([], None, 0)
+        if s == t:
+            return Caminho([], 0.0, 1)
+
+        offsets, head, w = map(memoryview, (self.offsets, self.head, self.weights[perfil]))
+        rev_offsets, rev_arcs, tail = map(memoryview, (self.rev_offsets, self.rev_arcs, self.tail))
+        k = 0.5 * self.h_factor[perfil]
+        if k > 0:
+            x, y = memoryview(self.x), memoryview(self.y)
+            xs, ys, xt, yt = x[s], y[s], x[t], y[t]
+            hypot = math.hypot
+            pot_cache = {}
+
+            def pot(v):
+                p = pot_cache.get(v)
+                if p is None:
+                    p = pot_cache[v] = k * (hypot(x[v] - xt, y[v] - yt) - hypot(x[v] - xs, y[v] - ys))
+                return p
+        else:
+            def pot(v):
+                return 0.0
+
+        dist_f, dist_r = {s: 0.0}, {t: 0.0}
+        pred_f, pred_r = {}, {}
+        done_f, done_r = set(), set()
+        heap_f, heap_r = [(pot(s), s)], [(-pot(t), t)]
+        mu, meet = INF, None
+
+        while heap_f and heap_r:
+            if heap_f[0][0] + heap_r[0][0] >= mu:
+                break
+            if heap_f[0][0] <= heap_r[0][0]:
+                _, u = heapq.heappop(heap_f)
+                if u in done_f:
+                    continue
+                done_f.add(u)
+                du = dist_f[u]
+                for a in range(offsets[u], offsets[u + 1]):
+                    v = head[a]
+                    nd = du + w[a]
+                    if nd < dist_f.get(v, INF):
+                        dist_f[v] = nd
+                        pred_f[v] = a
+                        heapq.heappush(heap_f, (nd + pot(v), v))
+                        if v in dist_r and nd + dist_r[v] < mu:
+                            mu, meet = nd + dist_r[v], v
+            else:
+                _, u = heapq.heappop(heap_r)
+                if u in done_r:
+                    continue
+                done_r.add(u)
+                du = dist_r[u]
+                for i in range(rev_offsets[u], rev_offsets[u + 1]):
+                    a = rev_arcs[i]
+                    v = tail[a]
+                    nd = du + w[a]
+                    if nd < dist_r.get(v, INF):
+                        dist_r[v] = nd
+                        pred_r[v] = a
+                        heapq.heappush(heap_r, (nd - pot(v), v))
+                        if v in dist_f and nd + dist_f[v] < mu:
+                            mu, meet = nd + dist_f[v], v
+
+        visitados = len(done_f) + len(done_r)
+        if meet is None:
+            return Caminho([], None, visitados)
+
+        arcs = self._unpack(pred_f, s, meet)
+        v = meet
+        while v != t:
+            a = pred_r[v]
+            arcs.append(a)
+            v = head[a]
+        return Caminho(self.edge[arcs].tolist(), mu, visitados)
+
+
+    def alt(self, perfil, start, end):
+        """A* com limites inferiores dos landmarks (ALT) e reabertura de vertices.
+
+        h(v) = max sobre os landmarks ativos de d(L, t) - d(L, v) e d(v, L) - d(t, L),
+        menos a folga do float32: continua admissivel com os multiplicadores de rodovia
+        e obra de arte, que o limite euclidiano do astar nao enxerga. Sem landmarks
+        para o perfil, usa o A* bidirecional.
+        """
+        lm = self.landmarks.get(perfil)
+        if lm is None:
+            return self.astar(perfil, start, end)
+        s, t = self.index(start), self.index(end)
+        if s is None or t is None:
+            return Caminho([], None, 0)
+        if s == t:
+            return Caminho([], 0.0, 1)
+        ativos = lm.active(s, t)
+        if not ativos:
+            return self.astar(perfil, start, end)
+
+        de, para, folga = lm.de, lm.para, lm.folga
+        de_t = [(i, float(de[t, i])) for i in ativos]
+        para_t = [(i, float(para[t, i])) for i in ativos]
+        h_cache = {}
+
+        def h(v):
+            r = h_cache.get(v)
+            if r is None:
+                dv, pv = de[v].tolist(), para[v].tolist()
+                r = h_cache[v] = max(0.0, max([d - dv[i] for i, d in de_t]
+                                              + [pv[i] - d for i, d in para_t]) - folga)
+            return r
+
+        offsets, head, w = map(memoryview, (self.offsets, self.head, self.weights[perfil]))
+        dist = {s: 0.0}
+        pred = {}
+        heap = [(h(s), 0.0, s)]
+        fechados = set()
+        while heap:
+            _, d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            fechados.add(u)
+            if u == t:
+                break
+            for a in range(offsets[u], offsets[u + 1]):
+                nd = d + w[a]
+                v = head[a]
+                if nd < dist.get(v, INF):
+                    hv = h(v)
+                    if hv == INF:
+                        continue
+                    dist[v] = nd
+                    pred[v] = a
+                    heapq.heappush(heap, (nd + hv, nd, v))
+
+        if t not in fechados:
+            return Caminho([], None, len(fechados))
+        return Caminho(self.edge[self._unpack(pred, s, t)].tolist(), dist[t], len(fechados))
+
+
+class Landmarks:
+    """Distancias de e para ALT_LANDMARKS vertices de um perfil, em float32 (vertice x landmark).
+
+    de[v, i] = d(L_i, v) e para[v, i] = d(v, L_i); inf onde nao ha caminho.
+    """
+
+    def __init__(self, vertices, de, para):
+        self.vertices = np.asarray(vertices, dtype=np.int64)
+        # ndarray sobre o mesmo buffer: indexar um np.memmap linha a linha e bem mais lento
+        self.de = np.asarray(de)
+        self.para = np.asarray(para)
+        self._folga = None
+
+    @property
+    def folga(self):
+        """Erro maximo de arredondamento de uma diferenca de duas distancias em float32."""
+        if self._folga is None:
+            maior = 0.0
+            for arr in (self.de, self.para):
+                finitos = arr[np.isfinite(arr)]
+                if len(finitos):
+                    maior = max(maior, float(finitos.max()))
+            self._folga = float(2 * np.spacing(np.float32(maior)))
+        return self._folga
+
+    @classmethod
+    def build(cls, g, perfil, k=ALT_LANDMARKS):
+        """Selecao farthest-point na componente principal do perfil.
+
+        Cada novo landmark e o vertice mais distante (ida + volta) dos ja escolhidos;
+        as buscas de selecao ja sao as tabelas de distancia.
+        """
+        mat = g._sparse(perfil)[0]
+        principal = g.components(perfil) == 0
+        n = g.n_vertices
+        de = np.empty((n, 0), dtype=np.float32)
+        para = np.empty((n, 0), dtype=np.float32)
+        if not principal.any():
+            return cls([], de, para)
+        # Primeiro: o mais distante de um vertice qualquer da componente principal
+        d0 = sp_dijkstra(mat, indices=int(np.argmax(principal)))
+        prox = int(np.argmax(np.where(principal & np.isfinite(d0), d0, -1)))
+        escolhidos, cols_de, cols_para = [], [], []
+        perto = np.full(n, np.inf)
+        for _ in range(min(k, int(principal.sum()))):
+            escolhidos.append(prox)
+            d_de = sp_dijkstra(mat, indices=prox)
+            d_para = sp_dijkstra(mat.T, indices=prox)
+            cols_de.append(d_de.astype(np.float32))
+            cols_para.append(d_para.astype(np.float32))
+            perto = np.minimum(perto, d_de + d_para)
+            prox = int(np.argmax(np.where(principal, perto, -1)))
+            if perto[prox] <= 0:
+                break
+        return cls(g.vertex_ids[escolhidos], np.column_stack(cols_de), np.column_stack(cols_para))
+
+    def active(self, s, t):
+        """Ate ALT_ATIVOS landmarks com o maior limite inferior para d(s, t)."""
+        ds, dt, ps, pt = (np.asarray(a, dtype=np.float64) for a in
+                          (self.de[s], self.de[t], self.para[s], self.para[t]))
+        ok = np.isfinite(ds) & np.isfinite(dt) & np.isfinite(ps) & np.isfinite(pt)
+        lim = np.where(ok, np.maximum(dt - ds, ps - pt), -np.inf)
+        ordem = np.argsort(-lim, kind="stable")[:ALT_ATIVOS]
+        return [int(i) for i in ordem if ok[i]]
+
+    @classmethod
+    def from_db(cls, cur, g, perfil):
+        cur.execute("""
+            SELECT vertice, de, para FROM alt_distancias
+            WHERE perfil = %s ORDER BY ordem
+        """, (perfil,))
+        rows = cur.fetchall()
+        n = g.n_vertices
+        de = np.column_stack([np.frombuffer(r[1], dtype=np.float32) for r in rows]) if rows \
+            else np.empty((n, 0), dtype=np.float32)
+        para = np.column_stack([np.frombuffer(r[2], dtype=np.float32) for r in rows]) if rows \
+            else np.empty((n, 0), dtype=np.float32)
+        return cls([r[0] for r in rows], de, para)
+
+    def save(self, cur, perfil, assinatura):
+        """Uma linha por landmark: as duas colunas de distancia em bytea (float32, ordem de vertex_ids)."""
+        for tabela in ("alt_distancias", "alt_meta"):
+            cur.execute(f"DELETE FROM {tabela} WHERE perfil = %s", (perfil,))
+        for i, vid in enumerate(self.vertices.tolist()):
+            cur.execute("""
+                INSERT INTO alt_distancias (perfil, ordem, vertice, de, para)
+                VALUES (%s, %s, %s, %s, %s)
+            """, (perfil, i, vid, np.ascontiguousarray(self.de[:, i]).tobytes(),
+                  np.ascontiguousarray(self.para[:, i]).tobytes()))
+        cur.execute("INSERT INTO alt_meta (perfil, assinatura) VALUES (%s, %s)",
+                    (perfil, assinatura))
+
+
+class Hierarchy:
+    """Contraction hierarchy de um perfil: ordem dos vertices + arcos com atalhos.
+
+    Arcos originais tem `edge` = id em rede e filhos -1; atalhos tem edge -1 e
+    apontam para os dois arcos (filho1, filho2) que substituem.
+    """
+
+    def __init__(self, rank, tail, head, weight, edge, child1, child2):
+        self.rank = np.asarray(rank, dtype=np.int64)
+        self.tail = np.asarray(tail, dtype=np.int64)
+        self.head = np.asarray(head, dtype=np.int64)
+        self.weight = np.asarray(weight, dtype=np.float64)
+        self.edge = np.asarray(edge, dtype=np.int64)
+        self.child1 = np.asarray(child1, dtype=np.int64)
+        self.child2 = np.asarray(child2, dtype=np.int64)
+        self._subida = None
+        self._atributos = None
+
+    def _graphs(self):
+        # Grafos de subida em CSR (arrays planos), montados no primeiro uso: o direto com
+        # os arcos u -> v de rank[v] > rank[u]; o reverso com os arcos v -> u de
+        # rank[v] > rank[u] invertidos, para a busca a partir do destino tambem subir
+        if self._subida is None:
+            up = self.rank[self.head] > self.rank[self.tail]
+            self._subida = (self._upward(np.flatnonzero(up), self.tail, self.head),
+                            self._upward(np.flatnonzero(~up), self.head, self.tail))
+        return self._subida
+
+    def _upward(self, arcs, de, para):
+        """(matriz, chaves, arcos) do grafo de subida, com arcos paralelos reduzidos ao menor peso."""
+        n = len(self.rank)
+        keys = de[arcs] * n + para[arcs]
+        order = np.lexsort((self.weight[arcs], keys))
+        arcs, keys = arcs[order], keys[order]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        arcs, keys = arcs[first], keys[first]
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(de[arcs], minlength=n), out=indptr[1:])
+        # Ja ordenados por (de, para): os arrays entram direto no CSR, zeros explicitos inclusive
+        mat = csr_matrix((self.weight[arcs], para[arcs].astype(np.int32), indptr.astype(np.int32)),
+                         shape=(n, n))
+        return mat, keys, arcs
+
+    @property
+    def n_shortcuts(self):
+        return int(np.count_nonzero(self.child1 >= 0))
+
+    @classmethod
+    def build(cls, g, perfil):
+        """Contrai os vertices em ordem de prioridade.
+
+        Prioridade = 2 x diferenca de arestas (atalhos - arcos removidos) + vizinhos ja
+        contraidos + 2 x nivel na hierarquia; recalculada para os vizinhos a cada
+        contracao e de novo (preguicosa) quando o vertice sai do heap.
+        """
+        n = g.n_vertices
+        w_all = g.weights[perfil]
+
+        # Arcos iniciais: originais finitos, sem lacos, o menor entre paralelos
+        ok = np.flatnonzero(np.isfinite(w_all) & (g.tail != g.head))
+        ok = ok[np.lexsort((w_all[ok], g.head[ok], g.tail[ok]))]
+        first = np.ones(len(ok), dtype=bool)
+        first[1:] = (g.tail[ok][1:] != g.tail[ok][:-1]) | (g.head[ok][1:] != g.head[ok][:-1])
+        ok = ok[first]
+        tail, head = g.tail[ok].tolist(), g.head[ok].tolist()
+        weight, edge = w_all[ok].tolist(), g.edge[ok].tolist()
+        child1, child2 = [-1] * len(ok), [-1] * len(ok)
+
+        out = [dict() for _ in range(n)]
+        inn = [dict() for _ in range(n)]
+        for a, (u, v) in enumerate(zip(tail, head)):
+            out[u][v] = a
+            inn[v][u] = a
+
+        pop, push = heapq.heappop, heapq.heappush
+
+        def witness(u, skip, targets, maximo):
+            # Dijkstra local de u sem passar por skip ate fixar `maximo` vertices; para
+            # antes quando nenhum alvo pendente pode mais ter caminho <= o do atalho
+            pending = dict(targets)
+            limit = max(pending.values())
+            dist = {u: 0.0}
+            heap = [(0.0, u)]
+            while heap and maximo:
+                d, x = pop(heap)
+                if d > limit:
+                    break
+                if d > dist[x]:
+                    continue
+                if pending.pop(x, None) == limit:
+                    if not pending:
+                        break
+                    limit = max(pending.values())
+                maximo -= 1
+                for y, a in out[x].items():
+                    if y != skip:
+                        nd = d + weight[a]
+                        if nd <= limit and nd < dist.get(y, INF):
+                            dist[y] = nd
+                            push(heap, (nd, y))
+            return dist
+
+        def shortcuts(v, maximo=CH_WITNESS_LIMIT):
+            found = []
+            for u, ia in inn[v].items():
+                cand = {x: weight[ia] + weight[oa] for x, oa in out[v].items() if x != u}
+                if not cand:
+                    continue
+                dist = witness(u, v, cand, maximo)
+                for x, wc in cand.items():
+                    if dist.get(x, INF) > wc:
+                        found.append((u, x, wc, ia, out[v][x]))
+            return found
+
+        deleted = [0] * n
+        level = [0] * n
+
+        def priority(v, sc):
+            return 2 * (len(sc) - len(inn[v]) - len(out[v])) + deleted[v] + 2 * level[v]
+
+        prio = [priority(v, shortcuts(v, CH_ESTIMATIVA_LIMIT)) for v in range(n)]
+        heap = list(zip(prio, range(n)))
+        heapq.heapify(heap)
+        rank = [0] * n
+        r = 0
+        while heap:
+            p, v = heapq.heappop(heap)
+            # Entrada antiga (prioridade refeita depois) ou vertice ja contraido
+            if out[v] is None or p != prio[v]:
+                continue
+            sc = shortcuts(v)
+            p = prio[v] = priority(v, sc)
+            # Atualizacao preguicosa: so contrai se continua sendo o de menor prioridade
+            if heap and p > heap[0][0]:
+                heapq.heappush(heap, (p, v))
+                continue
+            for u, x, wc, a1, a2 in sc:
+                cur = out[u].get(x)
+                if cur is None or wc < weight[cur]:
+                    a = len(tail)
+                    tail.append(u)
+                    head.append(x)
+                    weight.append(wc)
+                    edge.append(-1)
+                    child1.append(a1)
+                    child2.append(a2)
+                    out[u][x] = a
+                    inn[x][u] = a
+            vizinhos = set(inn[v]) | set(out[v])
+            for u in inn[v]:
+                del out[u][v]
+            for x in out[v]:
+                del inn[x][v]
+            inn[v] = out[v] = None
+            rank[v] = r
+            r += 1
+            for u in vizinhos:
+                deleted[u] += 1
+                level[u] = max(level[u], level[v] + 1)
+                prio[u] = priority(u, shortcuts(u, CH_ESTIMATIVA_LIMIT))
+                heapq.heappush(heap, (prio[u], u))
+
+        return cls(rank, tail, head, weight, edge, child1, child2)
+
+    @classmethod
+    def from_db(cls, cur, g, perfil):
+        cur.execute("SELECT vertice, nivel FROM ch_ordem WHERE perfil = %s", (perfil,))
+        ordem = np.array(cur.fetchall(), dtype=np.int64).reshape(-1, 2)
+        rank = np.zeros(g.n_vertices, dtype=np.int64)
+        rank[np.searchsorted(g.vertex_ids, ordem[:, 0])] = ordem[:, 1]
+        cur.execute("""
+            SELECT source, target, cost, edge, filho1, filho2
+            FROM ch_arcos WHERE perfil = %s ORDER BY id
+        """, (perfil,))
+        arr = np.array(cur.fetchall(), dtype=np.float64).reshape(-1, 6)
+        ids = arr[:, [0, 1, 3, 4, 5]].astype(np.int64)
+        return cls(rank, np.searchsorted(g.vertex_ids, ids[:, 0]),
+                   np.searchsorted(g.vertex_ids, ids[:, 1]),
+                   arr[:, 2], ids[:, 2], ids[:, 3], ids[:, 4])
+
+    def save(self, cur, g, perfil, assinatura):
+        """Grava ordem e arcos (ids de rede_vertices_pgr) via COPY."""
+        for tabela in ("ch_ordem", "ch_arcos", "ch_meta"):
+            cur.execute(f"DELETE FROM {tabela} WHERE perfil = %s", (perfil,))
+        with cur.copy("COPY ch_ordem (perfil, vertice, nivel) FROM STDIN") as copy:
+            for vid, r in zip(g.vertex_ids.tolist(), self.rank.tolist()):
+                copy.write_row((perfil, vid, r))
+        vids = g.vertex_ids
+        rows = zip(vids[self.tail].tolist(), vids[self.head].tolist(), self.weight.tolist(),
+                   self.edge.tolist(), self.child1.tolist(), self.child2.tolist())
+        with cur.copy("""COPY ch_arcos (perfil, id, source, target, cost, edge, filho1, filho2)
+                         FROM STDIN""") as copy:
+            for i, row in enumerate(rows):
+                copy.write_row((perfil, i) + row)
+        cur.execute("INSERT INTO ch_meta (perfil, assinatura) VALUES (%s, %s)",
+                    (perfil, assinatura))
+
+    def _expand(self, arcs):
+        c1, c2, edge = map(memoryview, (self.child1, self.child2, self.edge))
+        edges = []
+        stack = list(reversed(arcs))
+        while stack:
+            a = stack.pop()
+            if c1[a] < 0:
+                edges.append(edge[a])
+            else:
+                stack.append(c2[a])
+                stack.append(c1[a])
+        return edges
+
+    def _climb(self, grafo, pred, v, raiz):
+        # Arcos da CH de raiz ate v na arvore de predecessores de uma busca de subida
+        _, keys, arcs = grafo
+        n = len(self.rank)
+        caminho = [v]
+        while v != raiz:
+            v = int(pred[v])
+            caminho.append(v)
+        caminho = np.array(caminho[::-1], dtype=np.int64)
+        return arcs[np.searchsorted(keys, caminho[:-1] * n + caminho[1:])]
+
+    def query(self, s, t):
+        """Busca bidirecional so subindo na hierarquia; s e t sao indices internos.
+
+        Cada lado e um Dijkstra do scipy.csgraph no seu grafo de subida, que so fixa
+        os vertices acima do ponto de partida; o encontro e o vertice de menor soma.
+        """
+        if s == t:
+            return Caminho([], 0.0, 1)
+        up, down = self._graphs()
+        dist_f, pred_f = sp_dijkstra(up[0], indices=s, return_predecessors=True)
+        dist_r, pred_r = sp_dijkstra(down[0], indices=t, return_predecessors=True)
+        visitados = int(np.count_nonzero(np.isfinite(dist_f)) + np.count_nonzero(np.isfinite(dist_r)))
+        total = dist_f + dist_r
+        meet = int(np.argmin(total))
+        mu = float(total[meet])
+        if not np.isfinite(mu):
+            return Caminho([], None, visitados)
+        ida = self._climb(up, pred_f, meet, s)
+        # No grafo reverso a arvore vai de t ate o encontro; os arcos voltam na ordem da rota
+        volta = self._climb(down, pred_r, meet, t)[::-1]
+        return Caminho(self._expand(np.concatenate([ida, volta]).tolist()), mu, visitados)
+
+    def _arc_attributes(self, g):
+        """Comprimento e subida de cada arco da CH no grafo g; um atalho soma os dos filhos."""
+        if self._atributos is None:
+            n = g.n_vertices
+            orig = np.flatnonzero(self.child1 < 0)
+            # Arco original do grafo pela aresta e pelo vertice de saida
+            ordem = np.lexsort((g.tail, g.edge))
+            chaves = g.edge[ordem] * n + g.tail[ordem]
+            arco = ordem[np.searchsorted(chaves, self.edge[orig] * n + self.tail[orig])]
+            comp, sub = np.zeros(len(self.edge)), np.zeros(len(self.edge))
+            comp[orig], sub[orig] = g.comprimento[arco], g.subida[arco]
+            # Filhos vem antes do atalho: cada passada resolve mais um nivel de aninhamento
+            pronto = self.child1 < 0
+            resta = np.flatnonzero(~pronto)
+            while len(resta):
+                c1, c2 = self.child1[resta], self.child2[resta]
+                ok = pronto[c1] & pronto[c2]
+                a = resta[ok]
+                comp[a] = comp[c1[ok]] + comp[c2[ok]]
+                sub[a] = sub[c1[ok]] + sub[c2[ok]]
+                pronto[a] = True
+                resta = resta[~ok]
+            self._atributos = comp, sub
+        return self._atributos
+
+    def _spaces(self, grafo, parada, raizes, comp, sub):
+        """Espacos de busca de subida das raizes: (linha, vertice, custo, comprimento, subida).
+
+        Comprimento e subida sao somados pela arvore da busca ate a raiz. Ficam de fora
+        os vertices que um arco descendo de um vertice ja alcancado chega com custo
+        menor (stall-on-demand): o custo deles nao e o minimo, e o encontro nunca e neles.
+        """
+        mat, keys, arcs = grafo
+        n = len(self.rank)
+        dist, pred = sp_dijkstra(mat, indices=raizes, return_predecessors=True)
+        linha, v = np.nonzero(np.isfinite(dist))
+        d = dist[linha, v]
+        p = pred[linha, v].astype(np.int64)
+        tem = p >= 0
+        arco = arcs[np.searchsorted(keys, np.where(tem, p * n + v, 0)).clip(0, len(keys) - 1)]
+        c, s = np.where(tem, comp[arco], 0.0), np.where(tem, sub[arco], 0.0)
+
+        # Somas por saltos dobrados: c acumula os arcos da celula ate x (exclusive);
+        # a raiz aponta para si mesma com atributo 0
+        pos = np.zeros(dist.shape, dtype=np.int64)
+        pos[linha, v] = np.arange(len(v))
+        x = pos[linha, np.where(tem, p, v)]
+        while True:
+            xx = x[x]
+            if (xx == x).all():
+                break
+            c, s, x = c + c[x], s + s[x], xx
+
+        ip, ix, w = parada.indptr, parada.indices, parada.data
+        grau = ip[v + 1] - ip[v]
+        rep = np.repeat(np.arange(len(v)), grau)
+        j = np.arange(len(rep)) - np.repeat(np.cumsum(grau) - grau, grau) + np.repeat(ip[v], grau)
+        parado = np.zeros(len(v), dtype=bool)
+        parado[rep[dist[linha[rep], ix[j]] + w[j] < d[rep]]] = True
+        k = ~parado
+        return linha[k], v[k], d[k], c[k], s[k]
+
+    def matrix(self, g, src, tgt, lote=32, bloco=128):
+        """Custo, comprimento e subida de cada origem a cada destino (indices internos, -1 fora).
+
+        Many-to-many por baldes: os espacos de busca de subida de um bloco de destinos
+        (no grafo reverso) formam uma tabela densa vertice x destino, e cada origem
+        combina o seu espaco com ela; o encontro de menor soma da o custo, e as somas
+        de comprimento e subida dos dois lados nesse vertice dao os outros valores.
+        """
+        up, down = self._graphs()
+        comp_a, sub_a = self._arc_attributes(g)
+        n = len(self.rank)
+        shape = (len(src), len(tgt))
+        custo, comp, subida = np.full(shape, np.inf), np.full(shape, np.inf), np.full(shape, np.inf)
+        ok_s, ok_t = np.flatnonzero(src >= 0), np.flatnonzero(tgt >= 0)
+
+        origens = []
+        for k in range(0, len(ok_s), lote):
+            linhas = ok_s[k:k + lote]
+            i, v, d, c, s = self._spaces(up, down[0], src[linhas], comp_a, sub_a)
+            lim = np.searchsorted(i, np.arange(len(linhas) + 1))
+            origens.extend((linhas[r], v[a:b], d[a:b], c[a:b], s[a:b])
+                           for r, (a, b) in enumerate(zip(lim[:-1], lim[1:])))
+
+        for k in range(0, len(ok_t), bloco):
+            colunas = ok_t[k:k + bloco]
+            j, v, d, c, s = self._spaces(down, up[0], tgt[colunas], comp_a, sub_a)
+            # Tabela dos baldes: linha por vertice alcancado, coluna por destino do bloco
+            vert, lin = np.unique(v, return_inverse=True)
+            pos = np.full(n, -1)
+            pos[vert] = np.arange(len(vert))
+            dist = np.full((len(vert), len(colunas)), np.inf)
+            dist[lin, j] = d
+            qual = np.zeros(dist.shape, dtype=np.int64)
+            qual[lin, j] = np.arange(len(j))
+            todas = np.arange(len(colunas))
+            for linha, fv, fd, fc, fs in origens:
+                r = pos[fv]
+                ok = r >= 0
+                if not ok.any():
+                    continue
+                r = r[ok]
+                tot = fd[ok][:, None] + dist[r]
+                m = tot.argmin(axis=0)
+                melhor = tot[m, todas]
+                q = qual[r[m], todas]
+                fin = np.isfinite(melhor)
+                custo[linha, colunas] = melhor
+                comp[linha, colunas] = np.where(fin, fc[ok][m] + c[q], np.inf)
+                subida[linha, colunas] = np.where(fin, fs[ok][m] + s[q], np.inf)
+        return custo, comp, subida
+
+
+# Snapshot aberto em cada processo de snapshot_matrix
+_snapshot_aberto = {}
+
+
+def snapshot_matrix(pasta, perfil, sources, targets):
+    """Graph.matrix sobre o snapshot em `pasta`, aberto uma vez por processo.
+
+    Para um ProcessPoolExecutor: o dijkstra do scipy.csgraph segura o GIL, entao
+    so processos separados calculam perfis (ou blocos da matriz) ao mesmo tempo.
+    """
+    g = _snapshot_aberto.get(pasta)
+    if g is None:
+        _snapshot_aberto.clear()
+        g = _snapshot_aberto[pasta] = Graph.open(pasta)
+    return g.matrix(perfil, sources, targets)
@@ -10,9 +10,14 @@ Bases de dados:
 """
 
 
-import os, sys, time
+import argparse, hashlib, inspect, io, os, shutil, sys, time, uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
+import numpy as np
 import psycopg
+from scipy.interpolate import LinearNDInterpolator, NearestNDInterpolator
+from scipy.ndimage import map_coordinates
+from grafo import Graph, Hierarchy, Landmarks, PERFIS, CUSTO_PADRAO
 
 
 DB = os.getenv("PGDATABASE", "ciclorota_bh")
@@ -22,6 +27,29 @@ HOST = os.getenv("PGHOST", "localhost")
 PORT = os.getenv("PGPORT", "5432")
 SRID = 31983
 DATA = Path(__file__).parent / "base de dados"
+# As etapas gravam no schema de trabalho (mantido entre execucoes para pular etapas
+# sem mudancas); a API le o schema publicado, trocado de uma vez ao final. Toda escrita
+# qualifica o schema: com search_path = etapas, public um DROP sem schema apagaria a
+# tabela de mesmo nome em public (bancos no layout antigo, ainda servidos pela API)
+WORK_SCHEMA = os.getenv("SETUP_SCHEMA", "etapas")
+SCHEMA = os.getenv("PGSCHEMA", "ciclorota")
+PUBLISHED_TABLES = [
+    "rede", "rede_vertices_pgr", "rota_cicloviaria", "faixa_rodagem_rodovia",
+    "logradouro_obra_de_arte", "ch_meta", "ch_ordem", "ch_arcos",
+    "alt_meta", "alt_distancias", "rede_versao",
+]
+# Snapshot binario do grafo para a API (um subdiretorio por versao da rede)
+GRAFO_DIR = Path(os.getenv("GRAFO_SNAPSHOT", Path(__file__).parent / "grafo_snapshot"))
+
+# Geometrias de exibicao: coluna geom_4326 + versoes simplificadas por faixa de zoom.
+# Tolerancia (m, no SRID da rede) ~ meio pixel na latitude de BH em cada zoom.
+DISPLAY_TABLES = {
+    "rede": "the_geom",  # vira a tabela intermediaria rede_exibicao
+    "rota_cicloviaria": "geom",
+    "faixa_rodagem_rodovia": "geom",
+    "logradouro_obra_de_arte": "geom",
+}
+SIMPLIFY_BANDS = {12: 18.0, 14: 4.5}
 
 REQUIRED_FILES = [
     "CIRCULACAO_VIARIA.csv",
@@ -42,6 +70,7 @@ def get_conn(dbname=None, autocommit=False):
     return psycopg.connect(
         dbname=dbname or DB, user=USER, password=PWD,
         host=HOST, port=PORT, autocommit=autocommit,
+        options=f"-c search_path={WORK_SCHEMA},public",
     )
 
 
@@ -56,59 +85,107 @@ def detect_encoding(path):
     return "utf-8"
 
 
-def load_csv(connection, csv_path, staging_cols, insert_sql):
-    """Carrega CSV com geometrias WKT usando staging table + COPY FROM STDIN (FORMAT CSV)."""
-    enc = detect_encoding(csv_path)
-    cur = connection.cursor()
+def split_csv(path, chunk_bytes):
+    """Faixas de bytes (inicio, fim) do arquivo, cortadas em fim de linha fora de aspas.
+
+    Uma quebra de linha so separa registros se o numero de aspas antes dela e par,
+    entao campos CSV com quebras de linha nunca sao cortados ao meio.
+    """
+    size = path.stat().st_size
+    bounds, alvo, pos, aspas = [0], chunk_bytes, 0, 0
+    with open(path, "rb") as f:
+        while alvo < size and (block := f.read(1 << 22)):
+            fim = pos + len(block)
+            while alvo < fim:
+                i = max(alvo - pos, 0)
+                corte = None
+                while (j := block.find(b"\n", i)) != -1:
+                    if (aspas + block.count(b'"', 0, j)) % 2 == 0:
+                        corte = j
+                        break
+                    i = j + 1
+                if corte is None:
+                    break
+                bounds.append(pos + corte + 1)
+                alvo = pos + corte + 1 + chunk_bytes
+            aspas += block.count(b'"')
+            pos = fim
+    if bounds[-1] < size:
+        bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def load_chunk(tabela, idx, inicio, fim, enc):
+    """Carrega uma faixa de linhas do CSV da tabela (processo separado, conexao propria).
+
+    COPY para uma staging UNLOGGED propria e INSERT ... SELECT ST_GeomFromText, de
+    modo que o parse do WKT de cada faixa roda em paralelo com as demais.
+    """
+    arquivo, _, staging_cols, insert_sql = DATASETS[tabela]
+    t = time.perf_counter()
+    with open(DATA / arquivo, "rb") as f:
+        f.seek(inicio)
+        data = f.read(fim - inicio)
+    # Sem round-trip de texto para arquivos ja em UTF-8
+    try:
+        data.decode(enc)
+        if enc != "utf-8":
+            data = data.decode(enc).encode("utf-8")
+    except UnicodeDecodeError:
+        data = data.decode(enc, errors="replace").encode("utf-8")
+
+    stg = f"_stg_{tabela}_{idx}"
+    c = get_conn()
+    cur = c.cursor()
     cur.execute("SET client_encoding TO 'UTF8'")
-
-    col_defs = ", ".join(f"{c} TEXT" for c in staging_cols)
-    cur.execute("DROP TABLE IF EXISTS _stg")
-    cur.execute(f"CREATE TEMP TABLE _stg ({col_defs})")
-
-    with open(csv_path, "r", encoding=enc, errors="replace") as f:
-        with cur.copy("COPY _stg FROM STDIN WITH (FORMAT CSV, HEADER TRUE)") as copy:
-            while chunk := f.read(65536):
-                copy.write(chunk.encode("utf-8"))
-
-    connection.commit()
-    cur.execute(insert_sql)
+    col_defs = ", ".join(f"{col} TEXT" for col in staging_cols)
+    cur.execute(f"DROP TABLE IF EXISTS {WORK_SCHEMA}.{stg}")
+    cur.execute(f"CREATE UNLOGGED TABLE {WORK_SCHEMA}.{stg} ({col_defs})")
+    header = "TRUE" if inicio == 0 else "FALSE"
+    with cur.copy(f"COPY {WORK_SCHEMA}.{stg} FROM STDIN WITH (FORMAT CSV, HEADER {header})") as copy:
+        copy.write(data)
+    cur.execute(insert_sql.format(stg=f"{WORK_SCHEMA}.{stg}"))
     count = cur.rowcount
-    connection.commit()
-    cur.execute("DROP TABLE IF EXISTS _stg")
-    connection.commit()
-    return count
-
-
+    cur.execute(f"DROP TABLE {WORK_SCHEMA}.{stg}")
+    c.commit()
+    cur.close()
+    c.close()
+    return tabela, count, len(data), time.perf_counter() - t
 
 
 def check_files():
-    log("[1/9] Verificando arquivos...")
+    log("[1/11] Verificando arquivos...")
     for f in REQUIRED_FILES:
         path = DATA / f
         assert path.exists(), f"Arquivo nao encontrado: {path}"
     log("  OK")
 
 
-def create_database():
-    log(f"[2/9] Criando banco '{DB}'...")
+def create_database(reset=False):
+    """Cria o banco se nao existir; com reset, apaga e recomeca do zero."""
+    log(f"[2/11] Criando banco '{DB}'...")
     c = get_conn("postgres", autocommit=True)
     cur = c.cursor()
     cur.execute(f"SELECT 1 FROM pg_database WHERE datname = '{DB}'")
-    if cur.fetchone():
+    existe = cur.fetchone() is not None
+    if existe and reset:
         cur.execute(f"DROP DATABASE {DB} WITH (FORCE)")
-    cur.execute(f"CREATE DATABASE {DB}")
+    if not existe or reset:
+        cur.execute(f"CREATE DATABASE {DB}")
+        log("  OK")
+    else:
+        log("  Banco existente mantido (use --reset para recriar)")
     cur.close()
     c.close()
-    log("  OK")
 
 
 def create_extensions():
-    log("[3/9] Habilitando PostGIS e pgRouting...")
+    log("[3/11] Habilitando PostGIS e pgRouting...")
     c = get_conn()
     cur = c.cursor()
-    cur.execute("CREATE EXTENSION IF NOT EXISTS postgis")
-    cur.execute("CREATE EXTENSION IF NOT EXISTS pgrouting")
+    cur.execute("CREATE EXTENSION IF NOT EXISTS postgis SCHEMA public")
+    cur.execute("CREATE EXTENSION IF NOT EXISTS pgrouting SCHEMA public")
+    cur.execute(f"CREATE SCHEMA IF NOT EXISTS {WORK_SCHEMA}")
     c.commit()
     cur.close()
     c.close()
@@ -117,30 +194,21 @@ def create_extensions():
 
 # 4: Carrega dados dos CSVs
 
-def load_data():
-    log("[4/9] Carregando dados...")
-    c = get_conn()
-    cur = c.cursor()
-
-    # circulacao_viaria
-    cur.execute(f"""
-        CREATE TABLE circulacao_viaria (
-            id_tcv INTEGER PRIMARY KEY,
+# Tabela: (arquivo, colunas, colunas da staging, INSERT a partir da staging {stg})
+DATASETS = {
+    "circulacao_viaria": (
+        "CIRCULACAO_VIARIA.csv",
+        """id_tcv INTEGER PRIMARY KEY,
             tipo_trecho TEXT,
             tipo_logradouro TEXT,
             logradouro TEXT,
             cod_logradouro INTEGER,
             source INTEGER,
             target INTEGER,
-            geom GEOMETRY(MULTILINESTRING, {SRID})
-        )
-    """)
-    c.commit()
-
-    n = load_csv(c, DATA / "CIRCULACAO_VIARIA.csv",
+            geom GEOMETRY(MULTILINESTRING, {srid})""",
         ["fid","id_tcv","tipo_trecho","tipo_logradouro","logradouro",
          "cod_logradouro","source","target","geometria"],
-        f"""INSERT INTO circulacao_viaria
+        f"""INSERT INTO {WORK_SCHEMA}.circulacao_viaria
             (id_tcv, tipo_trecho, tipo_logradouro, logradouro,
              cod_logradouro, source, target, geom)
             SELECT
@@ -152,119 +220,136 @@ def load_data():
                 NULLIF(TRIM(source),'')::INTEGER,
                 NULLIF(TRIM(target),'')::INTEGER,
                 ST_GeomFromText(geometria, {SRID})
-            FROM _stg
+            FROM {{stg}}
             WHERE geometria IS NOT NULL AND TRIM(geometria) != ''
-        """)
-    log(f"  circulacao_viaria: {n} registros")
-
-    # curva_nivel_5m
-    cur.execute(f"""
-        CREATE TABLE curva_nivel_5m (
-            id_cn5m INTEGER,
+        """),
+    "curva_nivel_5m": (
+        "CURVA_DE_NIVEL_5M.csv",
+        """id_cn5m INTEGER,
             cota DOUBLE PRECISION,
-            geom GEOMETRY(MULTILINESTRING, {SRID})
-        )
-    """)
-    c.commit()
-
-    n = load_csv(c, DATA / "CURVA_DE_NIVEL_5M.csv",
+            geom GEOMETRY(MULTILINESTRING, {srid})""",
         ["fid","id_cn5m","geometria","cota"],
-        f"""INSERT INTO curva_nivel_5m (id_cn5m, cota, geom)
+        f"""INSERT INTO {WORK_SCHEMA}.curva_nivel_5m (id_cn5m, cota, geom)
             SELECT
                 NULLIF(TRIM(id_cn5m),'')::INTEGER,
                 NULLIF(TRIM(cota),'')::DOUBLE PRECISION,
                 ST_GeomFromText(geometria, {SRID})
-            FROM _stg
+            FROM {{stg}}
             WHERE geometria IS NOT NULL AND TRIM(geometria) != ''
-        """)
-    log(f"  curva_nivel_5m: {n} registros")
-
-    # faixa_rodagem_rodovia
-    cur.execute(f"""
-        CREATE TABLE faixa_rodagem_rodovia (
-            id_fx_rod INTEGER,
-            geom GEOMETRY(MULTILINESTRING, {SRID})
-        )
-    """)
-    c.commit()
-
-    n = load_csv(c, DATA / "FAIXA_RODAGEM_RODOVIA.csv",
+        """),
+    "faixa_rodagem_rodovia": (
+        "FAIXA_RODAGEM_RODOVIA.csv",
+        """id_fx_rod INTEGER,
+            geom GEOMETRY(MULTILINESTRING, {srid})""",
         ["fid","id_fx_rod","geometria"],
-        f"""INSERT INTO faixa_rodagem_rodovia (id_fx_rod, geom)
+        f"""INSERT INTO {WORK_SCHEMA}.faixa_rodagem_rodovia (id_fx_rod, geom)
             SELECT
                 NULLIF(TRIM(id_fx_rod),'')::INTEGER,
                 ST_GeomFromText(geometria, {SRID})
-            FROM _stg
+            FROM {{stg}}
             WHERE geometria IS NOT NULL AND TRIM(geometria) != ''
-        """)
-    log(f"  faixa_rodagem_rodovia: {n} registros")
-
-    # logradouro_obra_de_arte
-    cur.execute(f"""
-        CREATE TABLE logradouro_obra_de_arte (
-            id_obrart INTEGER,
+        """),
+    "logradouro_obra_de_arte": (
+        "LOGRADOURO_OBRA_DE_ARTE.csv",
+        """id_obrart INTEGER,
             tipo_obra TEXT,
             denominacao TEXT,
-            geom GEOMETRY(MULTIPOLYGON, {SRID})
-        )
-    """)
-    c.commit()
-
-    n = load_csv(c, DATA / "LOGRADOURO_OBRA_DE_ARTE.csv",
+            geom GEOMETRY(MULTIPOLYGON, {srid})""",
         ["fid","id_obrart","tipo_obra","denominacao","geometria"],
-        f"""INSERT INTO logradouro_obra_de_arte (id_obrart, tipo_obra, denominacao, geom)
+        f"""INSERT INTO {WORK_SCHEMA}.logradouro_obra_de_arte (id_obrart, tipo_obra, denominacao, geom)
             SELECT
                 NULLIF(TRIM(id_obrart),'')::INTEGER,
                 NULLIF(TRIM(tipo_obra),''),
                 NULLIF(TRIM(denominacao),''),
                 ST_GeomFromText(geometria, {SRID})
-            FROM _stg
+            FROM {{stg}}
             WHERE geometria IS NOT NULL AND TRIM(geometria) != ''
-        """)
-    log(f"  logradouro_obra_de_arte: {n} registros")
-
-    # rota_cicloviaria
-    cur.execute(f"""
-        CREATE TABLE rota_cicloviaria (
-            id_rota INTEGER,
+        """),
+    "rota_cicloviaria": (
+        "ROTA_CICLOVIARIA.csv",
+        """id_rota INTEGER,
             nome_lograd TEXT,
             tipo_rota TEXT,
             situacao TEXT,
-            geom GEOMETRY(MULTILINESTRING, {SRID})
-        )
-    """)
-    c.commit()
-
-    n = load_csv(c, DATA / "ROTA_CICLOVIARIA.csv",
+            geom GEOMETRY(MULTILINESTRING, {srid})""",
         ["fid","id_rota","id_trecho","nome_lograd","ano_mes","tipo_rota",
          "posicionamento","extensao","situacao","sentido","largura","segregador","geometria"],
-        f"""INSERT INTO rota_cicloviaria (id_rota, nome_lograd, tipo_rota, situacao, geom)
+        f"""INSERT INTO {WORK_SCHEMA}.rota_cicloviaria (id_rota, nome_lograd, tipo_rota, situacao, geom)
             SELECT
                 NULLIF(TRIM(id_rota),'')::INTEGER,
                 NULLIF(TRIM(nome_lograd),''),
                 NULLIF(TRIM(tipo_rota),''),
                 NULLIF(TRIM(situacao),''),
                 ST_GeomFromText(geometria, {SRID})
-            FROM _stg
+            FROM {{stg}}
             WHERE geometria IS NOT NULL AND TRIM(geometria) != ''
-        """)
-    log(f"  rota_cicloviaria: {n} registros")
+        """),
+}
+
+# Processos de carga e tamanho das faixas de linhas dos arquivos grandes
+LOAD_WORKERS = int(os.getenv("LOAD_WORKERS", str(min(8, os.cpu_count() or 4))))
+LOAD_CHUNK_MB = int(os.getenv("LOAD_CHUNK_MB", "32"))
+
 
+def load_data(tabelas=None):
+    """Carrega os datasets indicados (todos por padrao), recriando suas tabelas."""
+    log("[4/11] Carregando dados...")
+    tabelas = list(tabelas or DATASETS)
+    c = get_conn()
+    cur = c.cursor()
+    for tabela in tabelas:
+        cur.execute(f"DROP TABLE IF EXISTS {WORK_SCHEMA}.{tabela} CASCADE")
+        cur.execute(f"CREATE TABLE {WORK_SCHEMA}.{tabela} ({DATASETS[tabela][1].format(srid=SRID)})")
+    c.commit()
     cur.close()
     c.close()
 
+    # Cada arquivo vira uma ou mais faixas de linhas, carregadas em paralelo
+    tarefas = []
+    for tabela in tabelas:
+        path = DATA / DATASETS[tabela][0]
+        enc = detect_encoding(path)
+        for i, (inicio, fim) in enumerate(split_csv(path, LOAD_CHUNK_MB << 20)):
+            tarefas.append((tabela, i, inicio, fim, enc))
+
+    stats = {t: [0, 0, 0] for t in tabelas}  # linhas, bytes, faixas pendentes
+    for tabela, *_ in tarefas:
+        stats[tabela][2] += 1
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=LOAD_WORKERS) as pool:
+        futuros = [pool.submit(load_chunk, *t) for t in tarefas]
+        for f in as_completed(futuros):
+            tabela, n, nbytes, _ = f.result()
+            st = stats[tabela]
+            st[0] += n
+            st[1] += nbytes
+            st[2] -= 1
+            if st[2] == 0:
+                dt = time.perf_counter() - t0
+                log(f"  {tabela}: {st[0]} registros em {dt:.1f}s "
+                    f"({st[0] / dt:,.0f} linhas/s, {st[1] / dt / 1e6:.1f} MB/s)")
+    dt = time.perf_counter() - t0
+    total = sum(st[1] for st in stats.values())
+    log(f"  Total: {total / 1e6:.1f} MB em {dt:.1f}s ({LOAD_WORKERS} processos)")
+
 
 # 5: Cria indices espaciais
 
-def create_indexes():
-    log("[5/9] Criando indices espaciais...")
+INDICES = {
+    "circulacao_viaria": "idx_cv_geom",
+    "curva_nivel_5m": "idx_cn_geom",
+    "faixa_rodagem_rodovia": "idx_rod_geom",
+    "logradouro_obra_de_arte": "idx_oa_geom",
+    "rota_cicloviaria": "idx_rc_geom",
+}
+
+
+def create_indexes(tabelas=None):
+    log("[5/11] Criando indices espaciais...")
     c = get_conn()
     cur = c.cursor()
-    cur.execute("CREATE INDEX idx_cv_geom ON circulacao_viaria USING GIST(geom)")
-    cur.execute("CREATE INDEX idx_cn_geom ON curva_nivel_5m USING GIST(geom)")
-    cur.execute("CREATE INDEX idx_rod_geom ON faixa_rodagem_rodovia USING GIST(geom)")
-    cur.execute("CREATE INDEX idx_oa_geom ON logradouro_obra_de_arte USING GIST(geom)")
-    cur.execute("CREATE INDEX idx_rc_geom ON rota_cicloviaria USING GIST(geom)")
+    for tabela in tabelas or INDICES:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {INDICES[tabela]} ON {WORK_SCHEMA}.{tabela} USING GIST(geom)")
     c.commit()
     cur.close()
     c.close()
@@ -272,43 +357,42 @@ def create_indexes():
 
 
 # 6: Constroi rede de roteamento
+#
+# A rede e montada por CREATE TABLE AS, sem UPDATE sobre ela: cada etapa grava uma
+# tabela intermediaria UNLOGGED por id (arestas, topologia, flags, elevacao, exibicao)
+# e calculate_costs junta tudo, com os custos, numa unica escrita de rede.
+
+# Ajustes de sessao para CTAS e indices grandes (consultas paralelas, memoria de manutencao)
+PG_PARALLEL_WORKERS = int(os.getenv("PG_PARALLEL_WORKERS", "4"))
+PG_MAINTENANCE_MEM = os.getenv("PG_MAINTENANCE_MEM", "512MB")
+
+
+def tune_session(cur):
+    cur.execute(f"SET max_parallel_workers_per_gather = {PG_PARALLEL_WORKERS}")
+    cur.execute(f"SET max_parallel_maintenance_workers = {PG_PARALLEL_WORKERS}")
+    cur.execute(f"SET maintenance_work_mem = '{PG_MAINTENANCE_MEM}'")
+    cur.execute("SET parallel_setup_cost = 100")
+    cur.execute("SET parallel_tuple_cost = 0.01")
+
 
 def build_network():
-    log("[6/9] Construindo rede de roteamento...")
+    log("[6/11] Construindo rede de roteamento...")
     c = get_conn()
     cur = c.cursor()
+    tune_session(cur)
+    cur.execute(f"DROP TABLE IF EXISTS {WORK_SCHEMA}.rede_arestas, {WORK_SCHEMA}.rede_vertices_base, "
+                f"{WORK_SCHEMA}.rede_topologia CASCADE")
 
-    # Cria tabela de arestas
-    cur.execute(f"""
-        CREATE TABLE rede (
-            id SERIAL PRIMARY KEY,
-            tipo_logradouro TEXT,
-            logradouro TEXT,
-            comprimento DOUBLE PRECISION,
-            elev_source DOUBLE PRECISION DEFAULT 0,
-            elev_target DOUBLE PRECISION DEFAULT 0,
-            eh_rodovia BOOLEAN DEFAULT FALSE,
-            eh_obra_arte BOOLEAN DEFAULT FALSE,
-            eh_ciclovia BOOLEAN DEFAULT FALSE,
-            cost DOUBLE PRECISION,
-            reverse_cost DOUBLE PRECISION,
-            source INTEGER,
-            target INTEGER,
-            the_geom GEOMETRY(LINESTRING, {SRID})
-        )
-    """)
-    c.commit()
-
-    # Converte MULTILINESTRING para LINESTRING
+    # Arestas: MULTILINESTRING -> LINESTRING
+    t1 = time.time()
     cur.execute(f"""
-        INSERT INTO rede (tipo_logradouro, logradouro, comprimento, cost, reverse_cost, the_geom)
+        CREATE UNLOGGED TABLE {WORK_SCHEMA}.rede_arestas AS
         SELECT
+            (row_number() OVER ())::INTEGER AS id,
             tipo_logradouro,
             logradouro,
-            ST_Length(sub.geom),
-            ST_Length(sub.geom),
-            ST_Length(sub.geom),
-            sub.geom
+            ST_Length(sub.geom) AS comprimento,
+            sub.geom::GEOMETRY(LINESTRING, {SRID}) AS the_geom
         FROM (
             SELECT tipo_logradouro, logradouro,
                    (ST_Dump(ST_LineMerge(geom))).geom AS geom
@@ -318,247 +402,725 @@ def build_network():
         WHERE ST_GeometryType(sub.geom) = 'ST_LineString'
           AND ST_Length(sub.geom) > 0
     """)
+    log(f"  {cur.rowcount} arestas (LINESTRING) ({time.time()-t1:.0f}s)")
+    cur.execute(f"ALTER TABLE {WORK_SCHEMA}.rede_arestas ADD PRIMARY KEY (id)")
+    cur.execute(f"CREATE INDEX idx_ra_geom ON {WORK_SCHEMA}.rede_arestas USING GIST(the_geom)")
+    cur.execute(f"ANALYZE {WORK_SCHEMA}.rede_arestas")
     c.commit()
 
-    cur.execute("SELECT COUNT(*) FROM rede")
-    log(f"  {cur.fetchone()[0]} arestas (LINESTRING)")
-
-    # Extrai vertices da rede
+    # Vertices, ja com o SRID da rede
     log("  Extraindo vertices (pgr_extractVertices)...")
-    cur.execute("""
-        SELECT * INTO rede_vertices_pgr
-        FROM pgr_extractVertices('SELECT id, the_geom AS geom FROM rede ORDER BY id')
+    t1 = time.time()
+    cur.execute(f"""
+        CREATE UNLOGGED TABLE {WORK_SCHEMA}.rede_vertices_base AS
+        SELECT id, in_edges, out_edges, x, y,
+               ST_SetSRID(geom, {SRID})::GEOMETRY(POINT, {SRID}) AS geom
+        FROM pgr_extractVertices('SELECT id, the_geom AS geom FROM rede_arestas ORDER BY id')
     """)
-    c.commit()
+    n_v = cur.rowcount
+    cur.execute(f"ALTER TABLE {WORK_SCHEMA}.rede_vertices_base ADD PRIMARY KEY (id)")
 
-    # Preenche source
+    # source/target numa so passada, juntando out_edges e in_edges por aresta
     log("  Preenchendo source/target...")
-    cur.execute("""
-        WITH out_going AS (
-            SELECT id AS vid, unnest(out_edges) AS eid
-            FROM rede_vertices_pgr
-        )
-        UPDATE rede SET source = vid
-        FROM out_going WHERE rede.id = eid
+    cur.execute(f"""
+        CREATE UNLOGGED TABLE {WORK_SCHEMA}.rede_topologia AS
+        SELECT a.id, o.vid AS source, i.vid AS target
+        FROM rede_arestas a
+        LEFT JOIN (SELECT unnest(out_edges) AS eid, id AS vid FROM rede_vertices_base) o ON o.eid = a.id
+        LEFT JOIN (SELECT unnest(in_edges) AS eid, id AS vid FROM rede_vertices_base) i ON i.eid = a.id
     """)
+    cur.execute(f"ALTER TABLE {WORK_SCHEMA}.rede_topologia ADD PRIMARY KEY (id)")
+    cur.execute("SELECT COUNT(*) FROM rede_topologia WHERE source IS NOT NULL AND target IS NOT NULL")
+    n_e = cur.fetchone()[0]
     c.commit()
+    log(f"  {n_v} vertices, {n_e} arestas com topologia ({time.time()-t1:.0f}s)")
 
-    # Preenche target
-    cur.execute("""
-        WITH in_coming AS (
-            SELECT id AS vid, unnest(in_edges) AS eid
-            FROM rede_vertices_pgr
-        )
-        UPDATE rede SET target = vid
-        FROM in_coming WHERE rede.id = eid
-    """)
-    c.commit()
+    cur.close()
+    c.close()
 
-    # Adiciona elevacao aos vertices
-    cur.execute("ALTER TABLE rede_vertices_pgr ADD COLUMN elevacao DOUBLE PRECISION DEFAULT 0")
-    c.commit()
 
-    # Ajusta SRID da geometria dos vertices
-    cur.execute(f"""
-        ALTER TABLE rede_vertices_pgr
-        ALTER COLUMN geom TYPE GEOMETRY(POINT, {SRID})
-        USING ST_SetSRID(geom, {SRID})
-    """)
-    c.commit()
+# 7: Geometrias WGS84 multi-resolucao
 
-    cur.execute("CREATE INDEX idx_rede_geom ON rede USING GIST(the_geom)")
-    cur.execute("CREATE INDEX idx_rede_src ON rede (source)")
-    cur.execute("CREATE INDEX idx_rede_tgt ON rede (target)")
-    cur.execute("CREATE INDEX idx_rv_geom ON rede_vertices_pgr USING GIST(geom)")
-    c.commit()
-
-    cur.execute("ANALYZE rede")
-    cur.execute("ANALYZE rede_vertices_pgr")
-    c.commit()
+def display_columns(geom):
+    cols = {"geom_4326": f"ST_Transform({geom}, 4326)"}
+    for z, tol in SIMPLIFY_BANDS.items():
+        cols[f"geom_4326_z{z}"] = f"ST_Transform(ST_SimplifyPreserveTopology({geom}, {tol}), 4326)"
+    return cols
 
-    cur.execute("SELECT COUNT(*) FROM rede_vertices_pgr")
-    n_v = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM rede WHERE source IS NOT NULL AND target IS NOT NULL")
-    n_e = cur.fetchone()[0]
-    log(f"  {n_v} vertices, {n_e} arestas com topologia")
 
+def build_display_geometries():
+    log("[7/11] Pre-calculando geometrias WGS84 por faixa de zoom...")
+    c = get_conn()
+    cur = c.cursor()
+    tune_session(cur)
+    for tabela, geom in DISPLAY_TABLES.items():
+        t1 = time.time()
+        cols = display_columns(geom)
+        if tabela == "rede":
+            # Da rede so a tabela intermediaria; os indices saem na montagem final
+            cur.execute(f"DROP TABLE IF EXISTS {WORK_SCHEMA}.rede_exibicao")
+            cur.execute(f"CREATE UNLOGGED TABLE {WORK_SCHEMA}.rede_exibicao AS SELECT id, "
+                        + ", ".join(f"{expr}::GEOMETRY(GEOMETRY, 4326) AS {col}" for col, expr in cols.items())
+                        + f" FROM rede_arestas")
+            cur.execute(f"ALTER TABLE {WORK_SCHEMA}.rede_exibicao ADD PRIMARY KEY (id)")
+        else:
+            for col in cols:
+                cur.execute(f"ALTER TABLE {WORK_SCHEMA}.{tabela} ADD COLUMN IF NOT EXISTS {col} GEOMETRY(GEOMETRY, 4326)")
+            cur.execute(f"UPDATE {WORK_SCHEMA}.{tabela} SET " + ", ".join(f"{col} = {expr}" for col, expr in cols.items()))
+            for col in cols:
+                cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{tabela}_{col} ON {WORK_SCHEMA}.{tabela} USING GIST({col})")
+            cur.execute(f"ANALYZE {WORK_SCHEMA}.{tabela}")
+        c.commit()
+        log(f"  {tabela}: {', '.join(cols)} ({time.time()-t1:.0f}s)")
     cur.close()
     c.close()
 
 
-# 7: Classifica arestas
+# 8: Classifica arestas
+
+# Camadas de restricao: flag -> (tabela, predicado espacial com a aresta r.the_geom)
+CLASSIFICACAO = {
+    "eh_rodovia": ("faixa_rodagem_rodovia", "ST_DWithin(r.the_geom, s.geom, 10)"),
+    "eh_obra_arte": ("logradouro_obra_de_arte", "ST_Intersects(r.the_geom, s.geom)"),
+    "eh_ciclovia": ("rota_cicloviaria", "ST_DWithin(r.the_geom, s.geom, 10)"),
+}
+# Maximo de vertices por pedaco no ST_Subdivide (bbox pequeno = indice GIST seletivo)
+SUBDIVIDE_VERTICES = 64
+
 
 def classify_edges():
-    log("[7/9] Classificando restricoes (rodovia, obra de arte)...")
+    log("[8/11] Classificando restricoes (rodovia, obra de arte, ciclovia)...")
     c = get_conn()
     cur = c.cursor()
+    tune_session(cur)
+    t0 = time.time()
 
-    # Marca arestas em rodovia
-    cur.execute("""
-        UPDATE rede r SET eh_rodovia = TRUE
-        WHERE EXISTS (
-            SELECT 1 FROM faixa_rodagem_rodovia rod
-            WHERE ST_DWithin(r.the_geom, rod.geom, 10)
-        )
-    """)
-    n_rod = cur.rowcount
+    # Camadas subdivididas e indexadas: geometrias longas viram pedacos com bbox pequeno
+    for flag, (tabela, _) in CLASSIFICACAO.items():
+        t1 = time.time()
+        sub = f"sub_{tabela}"
+        cur.execute(f"DROP TABLE IF EXISTS {WORK_SCHEMA}.{sub}")
+        cur.execute(f"""
+            CREATE UNLOGGED TABLE {WORK_SCHEMA}.{sub} AS
+            SELECT ST_Subdivide(geom, {SUBDIVIDE_VERTICES}) AS geom
+            FROM {tabela} WHERE geom IS NOT NULL
+        """)
+        n = cur.rowcount
+        cur.execute(f"CREATE INDEX idx_{sub}_geom ON {WORK_SCHEMA}.{sub} USING GIST(geom)")
+        cur.execute(f"ANALYZE {WORK_SCHEMA}.{sub}")
+        log(f"  {sub}: {n} pedacos ({time.time()-t1:.1f}s)")
     c.commit()
 
-    # Marca arestas em obra de arte
-    cur.execute("""
-        UPDATE rede r SET eh_obra_arte = TRUE
-        WHERE EXISTS (
-            SELECT 1 FROM logradouro_obra_de_arte oa
-            WHERE ST_Intersects(r.the_geom, oa.geom)
-        )
-    """)
-    n_oa = cur.rowcount
+    # As tres flags numa so passada por aresta
+    t1 = time.time()
+    flags = ",\n".join(
+        f"EXISTS (SELECT 1 FROM sub_{tabela} s WHERE {pred}) AS {flag}"
+        for flag, (tabela, pred) in CLASSIFICACAO.items())
+    cur.execute(f"DROP TABLE IF EXISTS {WORK_SCHEMA}.rede_flags")
+    cur.execute(f"CREATE UNLOGGED TABLE {WORK_SCHEMA}.rede_flags AS SELECT r.id, {flags} FROM rede_arestas r")
+    cur.execute(f"ALTER TABLE {WORK_SCHEMA}.rede_flags ADD PRIMARY KEY (id)")
+    cur.execute("SELECT " + ", ".join(f"COUNT(*) FILTER (WHERE {f})" for f in CLASSIFICACAO)
+                + " FROM rede_flags")
+    n_rod, n_oa, n_rc = cur.fetchone()
     c.commit()
+    log(f"  rede_flags ({time.time()-t1:.1f}s)")
 
     log(f"  {n_rod} arestas em rodovia")
     log(f"  {n_oa} arestas em obra de arte")
-
-    # Marca arestas em ciclovia
-    cur.execute("""
-        UPDATE rede r SET eh_ciclovia = TRUE
-        WHERE EXISTS (
-            SELECT 1 FROM rota_cicloviaria rc
-            WHERE ST_DWithin(r.the_geom, rc.geom, 10)
-        )
-    """)
-    n_rc = cur.rowcount
-    c.commit()
     log(f"  {n_rc} arestas em ciclovia")
+    log(f"  Classificacao em {time.time()-t0:.1f}s")
 
     cur.close()
     c.close()
 
 
-# 8: Interpola elevacao
+# 9: Modelo de elevacao (DEM) a partir das curvas de nivel
+
+# Resolucao da grade (m) e espacamento das amostras ao longo das arestas (m)
+DEM_RES = float(os.getenv("DEM_RES", "10"))
+DEM_STEP = float(os.getenv("DEM_STEP", "10"))
+DEM_MARGIN = 200.0
+
+
+def copy_array(cur, sql, ncols):
+    """Resultado de uma consulta numerica como array (COPY TO STDOUT, sem tuplas Python)."""
+    buf = io.BytesIO()
+    with cur.copy(f"COPY ({sql}) TO STDOUT") as copy:
+        for data in copy:
+            buf.write(data)
+    if not buf.tell():
+        return np.empty((0, ncols))
+    buf.seek(0)
+    return np.loadtxt(buf, dtype=np.float64, ndmin=2).reshape(-1, ncols)
+
+
+def build_dem(x, y, z, bbox, res):
+    """Grade de elevacao por interpolacao linear (TIN) entre as curvas de nivel.
+
+    As cotas sao agregadas por celula (media) e trianguladas; celulas fora da
+    envoltoria da triangulacao recebem a cota da celula com curva mais proxima.
+    Retorna (grade, x0, y0) com a grade em linhas = y.
+    """
+    x0, y0 = bbox[0] - DEM_MARGIN, bbox[1] - DEM_MARGIN
+    nx = int(np.ceil((bbox[2] + DEM_MARGIN - x0) / res))
+    ny = int(np.ceil((bbox[3] + DEM_MARGIN - y0) / res))
+    ix, iy = ((x - x0) / res).astype(np.int64), ((y - y0) / res).astype(np.int64)
+    dentro = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+    cell = iy[dentro] * nx + ix[dentro]
+    soma = np.bincount(cell, weights=z[dentro], minlength=nx * ny)
+    cont = np.bincount(cell, minlength=nx * ny)
+    tem = np.flatnonzero(cont)
+    cx, cy = (tem % nx + 0.5) * res + x0, (tem // nx + 0.5) * res + y0
+    pts, val = np.column_stack([cx, cy]), soma[tem] / cont[tem]
+
+    gx, gy = np.meshgrid((np.arange(nx) + 0.5) * res + x0, (np.arange(ny) + 0.5) * res + y0)
+    alvo = np.column_stack([gx.ravel(), gy.ravel()])
+    grade = LinearNDInterpolator(pts, val)(alvo)
+    fora = np.isnan(grade)
+    if fora.any():
+        grade[fora] = NearestNDInterpolator(pts, val)(alvo[fora])
+    return grade.reshape(ny, nx).astype(np.float32), x0, y0
+
+
+def sample_dem(dem, x, y, res):
+    """Cota bilinear da grade nos pontos (x, y), numa unica chamada vetorizada."""
+    grade, x0, y0 = dem
+    return map_coordinates(grade, [(y - y0) / res - 0.5, (x - x0) / res - 0.5],
+                           order=1, mode="nearest")
+
 
 def interpolate_elevation():
-    log("[8/9] Interpolando elevacao...")
+    log("[9/11] Interpolando elevacao (DEM das curvas de nivel)...")
     c = get_conn()
     cur = c.cursor()
+    tune_session(cur)
+    cur.execute(f"DROP TABLE IF EXISTS {WORK_SCHEMA}.pontos_elev, {WORK_SCHEMA}.rede_vertices_elev, "
+                f"{WORK_SCHEMA}.rede_elevacao")
 
-    # Extrai pontos das curvas de nivel
+    # Pontos das curvas (densificados na resolucao da grade) na area da rede
     t1 = time.time()
-    cur.execute("""
-        CREATE TABLE pontos_elev AS
-        SELECT cota, (ST_DumpPoints(geom)).geom AS geom
-        FROM curva_nivel_5m
-        WHERE cota IS NOT NULL AND geom IS NOT NULL
-    """)
-    c.commit()
+    cur.execute("SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) FROM (SELECT ST_Extent(the_geom) e FROM rede_arestas) s")
+    bbox = cur.fetchone()
+    cn = copy_array(cur, f"""
+        SELECT ST_X(d.geom), ST_Y(d.geom), cn.cota
+        FROM curva_nivel_5m cn,
+             LATERAL ST_DumpPoints(ST_Segmentize(cn.geom, {DEM_RES})) d
+        WHERE cn.cota IS NOT NULL
+          AND cn.geom && ST_Expand(ST_MakeEnvelope({", ".join(map(str, bbox))}, {SRID}), {DEM_MARGIN})
+    """, 3)
+    log(f"  {len(cn)} pontos de curva de nivel ({time.time()-t1:.0f}s)")
 
-    cur.execute("SELECT COUNT(*) FROM pontos_elev")
-    log(f"  {cur.fetchone()[0]} pontos de elevacao extraidos ({time.time()-t1:.0f}s)")
-
-    cur.execute("CREATE INDEX idx_pe_geom ON pontos_elev USING GIST(geom)")
-    c.commit()
+    t1 = time.time()
+    dem = build_dem(cn[:, 0], cn[:, 1], cn[:, 2], bbox, DEM_RES)
+    log(f"  Grade {dem[0].shape[1]}x{dem[0].shape[0]} de {DEM_RES:g}m ({time.time()-t1:.0f}s)")
 
-    # Associa a cota mais proxima a cada vertice
+    # Vertices: uma amostragem vetorizada
     t1 = time.time()
-    cur.execute("""
-        UPDATE rede_vertices_pgr v SET elevacao = sub.cota
-        FROM (
-            SELECT v2.id, p.cota
-            FROM rede_vertices_pgr v2
-            CROSS JOIN LATERAL (
-                SELECT cota FROM pontos_elev p ORDER BY p.geom <-> v2.geom LIMIT 1
-            ) p
-        ) sub
-        WHERE v.id = sub.id
-    """)
-    c.commit()
-    log(f"  {cur.rowcount} vertices com elevacao ({time.time()-t1:.0f}s)")
+    v = copy_array(cur, "SELECT id, x, y FROM rede_vertices_base", 3)
+    elev = sample_dem(dem, v[:, 1], v[:, 2], DEM_RES)
+
+    # Arestas: pontos a cada DEM_STEP m, subida e descida acumuladas no sentido source -> target
+    p = copy_array(cur, f"""
+        SELECT r.id, ST_X(d.geom), ST_Y(d.geom)
+        FROM rede_arestas r, LATERAL ST_DumpPoints(ST_Segmentize(r.the_geom, {DEM_STEP})) d
+        ORDER BY r.id, d.path[1]
+    """, 3)
+    ids, idx = np.unique(p[:, 0].astype(np.int64), return_inverse=True)
+    dz = np.diff(sample_dem(dem, p[:, 1], p[:, 2], DEM_RES).astype(np.float64))
+    mesma = idx[1:] == idx[:-1]
+    subida = np.bincount(idx[1:][mesma], weights=np.maximum(dz[mesma], 0), minlength=len(ids))
+    descida = np.bincount(idx[1:][mesma], weights=np.maximum(-dz[mesma], 0), minlength=len(ids))
+    log(f"  {len(v)} vertices e {len(p)} pontos de {len(ids)} arestas amostrados ({time.time()-t1:.0f}s)")
 
-    cur.execute("SELECT MIN(elevacao), MAX(elevacao) FROM rede_vertices_pgr WHERE elevacao > 0")
+    t1 = time.time()
+    cur.execute(f"CREATE UNLOGGED TABLE {WORK_SCHEMA}.rede_vertices_elev (id INTEGER PRIMARY KEY, elevacao DOUBLE PRECISION)")
+    with cur.copy(f"COPY {WORK_SCHEMA}.rede_vertices_elev FROM STDIN") as copy:
+        for row in zip(v[:, 0].astype(np.int64).tolist(), elev.astype(np.float64).tolist()):
+            copy.write_row(row)
+    cur.execute("CREATE TEMP TABLE _elev_e (id INTEGER PRIMARY KEY, subida DOUBLE PRECISION, descida DOUBLE PRECISION)")
+    with cur.copy("COPY _elev_e FROM STDIN") as copy:
+        for row in zip(ids.tolist(), subida.tolist(), descida.tolist()):
+            copy.write_row(row)
+    log(f"  {len(v)} vertices com elevacao")
+
+    cur.execute("SELECT MIN(elevacao), MAX(elevacao) FROM rede_vertices_elev WHERE elevacao > 0")
     mn, mx = cur.fetchone()
     log(f"  Elevacao: {mn:.0f}m - {mx:.0f}m")
 
-    # Propaga elevacao para as arestas
-    cur.execute("""
-        UPDATE rede r SET elev_source = vs.elevacao, elev_target = vt.elevacao
-        FROM rede_vertices_pgr vs, rede_vertices_pgr vt
-        WHERE r.source = vs.id AND r.target = vt.id
+    # Elevacao dos vertices e subida/descida amostradas por aresta
+    cur.execute(f"""
+        CREATE UNLOGGED TABLE {WORK_SCHEMA}.rede_elevacao AS
+        SELECT t.id, vs.elevacao AS elev_source, vt.elevacao AS elev_target,
+               e.subida AS subida_m, e.descida AS descida_m
+        FROM rede_topologia t
+        JOIN rede_vertices_elev vs ON vs.id = t.source
+        JOIN rede_vertices_elev vt ON vt.id = t.target
+        JOIN _elev_e e ON e.id = t.id
     """)
+    n = cur.rowcount
+    cur.execute(f"ALTER TABLE {WORK_SCHEMA}.rede_elevacao ADD PRIMARY KEY (id)")
     c.commit()
-    log(f"  {cur.rowcount} arestas com elevacao propagada")
+    log(f"  {n} arestas com elevacao propagada ({time.time()-t1:.0f}s)")
 
     cur.close()
     c.close()
 
 
-# 9: Calcula custos
-
-def calculate_costs():
-    log("[9/9] Calculando custos...")
-    c = get_conn()
-    cur = c.cursor()
+# 10: Calcula custos e monta a rede final
 
-    # Calcula custo e custo reverso
-    cur.execute("""
-        UPDATE rede SET
-            cost = GREATEST(comprimento, 0.1)
+def cost_sql(origem, destino):
+    """Custo no sentido origem -> destino (parametros em grafo.CUSTO_PADRAO, os mesmos da API)."""
+    p = CUSTO_PADRAO
+    return f"""GREATEST(comprimento, 0.1)
                 * CASE
-                    WHEN elev_source > 0 AND elev_target > 0 AND comprimento > 0 THEN
+                    WHEN {origem} > 0 AND {destino} > 0 AND comprimento > 0 THEN
                         CASE
-                            WHEN elev_target > elev_source THEN
-                                1.0 + POWER((elev_target - elev_source) / comprimento * 100.0 / 8.0, 2)
+                            WHEN {destino} > {origem} THEN
+                                1.0 + POWER(({destino} - {origem}) / comprimento * 100.0 / {p["subida_ref"]}, 2)
                             ELSE
-                                GREATEST(0.4, 1.0 - (elev_source - elev_target) / comprimento * 100.0 / 25.0)
+                                GREATEST({p["descida_min"]}, 1.0 - ({origem} - {destino}) / comprimento * 100.0 / {p["descida_ref"]})
                         END
                     ELSE 1.0
                   END
-                * CASE WHEN eh_rodovia THEN 100.0 ELSE 1.0 END
-                * CASE WHEN eh_obra_arte THEN 50.0 ELSE 1.0 END
-                * CASE WHEN eh_ciclovia THEN 0.0 ELSE 1.0 END,
-            reverse_cost = GREATEST(comprimento, 0.1)
-                * CASE
-                    WHEN elev_source > 0 AND elev_target > 0 AND comprimento > 0 THEN
-                        CASE
-                            WHEN elev_source > elev_target THEN
-                                1.0 + POWER((elev_source - elev_target) / comprimento * 100.0 / 8.0, 2)
-                            ELSE
-                                GREATEST(0.4, 1.0 - (elev_target - elev_source) / comprimento * 100.0 / 25.0)
-                        END
-                    ELSE 1.0
-                  END
-                * CASE WHEN eh_rodovia THEN 100.0 ELSE 1.0 END
-                * CASE WHEN eh_obra_arte THEN 50.0 ELSE 1.0 END
-                * CASE WHEN eh_ciclovia THEN 0.0 ELSE 1.0 END
+                * CASE WHEN eh_rodovia THEN {p["rodovia"]} ELSE 1.0 END
+                * CASE WHEN eh_obra_arte THEN {p["obra_arte"]} ELSE 1.0 END
+                * CASE WHEN eh_ciclovia THEN {p["ciclovia"]} ELSE 1.0 END"""
+
+
+def strong_components(cur):
+    """Componentes por perfil (0 = a maior) na tabela temporaria _componentes.
+
+    comp_{perfil} sao as fortemente conexas, mesmo resultado de pgr_strongComponents,
+    e ilha_{perfil} as fracamente conexas (sem caminho possivel so entre ilhas diferentes).
+    Calculadas sobre o grafo em memoria, que ja trata custo negativo como sentido
+    removido; -1 fica para vertices fora da rede.
+    """
+    t1 = time.time()
+    a = copy_array(cur, """
+        SELECT id, source, target, cost, reverse_cost, comprimento FROM rede
+        WHERE source IS NOT NULL AND target IS NOT NULL
+    """, 6)
+    ids = a[:, :3].astype(np.int64)
+    g = Graph(ids[:, 0], ids[:, 1], ids[:, 2], a[:, 3], a[:, 4], a[:, 5])
+    comps = {p: g.components(p) for p in PERFIS}
+    ilhas = {p: g.islands(p) for p in PERFIS}
+    cur.execute("CREATE TEMP TABLE _componentes (id INTEGER PRIMARY KEY, "
+                + ", ".join(f"comp_{p} INTEGER" for p in PERFIS) + ", "
+                + ", ".join(f"ilha_{p} INTEGER" for p in PERFIS) + ")")
+    with cur.copy("COPY _componentes FROM STDIN") as copy:
+        for row in zip(g.vertex_ids.tolist(), *(c.tolist() for c in comps.values()),
+                       *(c.tolist() for c in ilhas.values())):
+            copy.write_row(row)
+    for p, c in comps.items():
+        principal = np.count_nonzero(c == 0)
+        log(f"  {p}: {c.max() + 1 if len(c) else 0} componentes, principal com "
+            f"{principal} de {len(c)} vertices, {ilhas[p].max() + 1 if len(c) else 0} ilhas")
+    log(f"  Componentes ({time.time()-t1:.1f}s)")
+
+
+def calculate_costs():
+    log("[10/11] Calculando custos e montando a rede...")
+    c = get_conn()
+    cur = c.cursor()
+    tune_session(cur)
+    cur.execute(f"DROP TABLE IF EXISTS {WORK_SCHEMA}.rede, {WORK_SCHEMA}.rede_vertices_pgr CASCADE")
+
+    # Uma unica escrita: intermediarias juntadas por id, custos calculados na mesma passada
+    t1 = time.time()
+    cur.execute(f"""
+        CREATE TABLE {WORK_SCHEMA}.rede AS
+        SELECT id, tipo_logradouro, logradouro, comprimento,
+               elev_source, elev_target, eh_rodovia, eh_obra_arte, eh_ciclovia,
+               {cost_sql("elev_source", "elev_target")} AS cost,
+               {cost_sql("elev_target", "elev_source")} AS reverse_cost,
+               source, target, the_geom, geom_4326, geom_4326_z12, geom_4326_z14,
+               subida_m, descida_m
+        FROM (
+            SELECT a.id, a.tipo_logradouro, a.logradouro, a.comprimento,
+                   COALESCE(e.elev_source, 0) AS elev_source,
+                   COALESCE(e.elev_target, 0) AS elev_target,
+                   COALESCE(f.eh_rodovia, FALSE) AS eh_rodovia,
+                   COALESCE(f.eh_obra_arte, FALSE) AS eh_obra_arte,
+                   COALESCE(f.eh_ciclovia, FALSE) AS eh_ciclovia,
+                   t.source, t.target, a.the_geom,
+                   x.geom_4326, x.geom_4326_z12, x.geom_4326_z14,
+                   COALESCE(e.subida_m, 0) AS subida_m,
+                   COALESCE(e.descida_m, 0) AS descida_m
+            FROM rede_arestas a
+            JOIN rede_topologia t USING (id)
+            LEFT JOIN rede_flags f USING (id)
+            LEFT JOIN rede_elevacao e USING (id)
+            LEFT JOIN rede_exibicao x USING (id)
+        ) r
+    """)
+    log(f"  rede: {cur.rowcount} arestas ({time.time()-t1:.0f}s)")
+
+    strong_components(cur)
+    cur.execute(f"""
+        CREATE TABLE {WORK_SCHEMA}.rede_vertices_pgr AS
+        SELECT b.id, b.in_edges, b.out_edges, b.x, b.y, b.geom,
+               COALESCE(e.elevacao, 0) AS elevacao,
+               {", ".join(f"COALESCE(k.comp_{p}, -1) AS comp_{p}" for p in PERFIS)},
+               {", ".join(f"COALESCE(k.ilha_{p}, -1) AS ilha_{p}" for p in PERFIS)}
+        FROM rede_vertices_base b
+        LEFT JOIN rede_vertices_elev e USING (id)
+        LEFT JOIN _componentes k USING (id)
+    """)
+
+    t1 = time.time()
+    cur.execute(f"ALTER TABLE {WORK_SCHEMA}.rede ADD PRIMARY KEY (id)")
+    cur.execute(f"ALTER TABLE {WORK_SCHEMA}.rede_vertices_pgr ADD PRIMARY KEY (id)")
+    cur.execute(f"CREATE INDEX idx_rede_geom ON {WORK_SCHEMA}.rede USING GIST(the_geom)")
+    cur.execute(f"CREATE INDEX idx_rede_src ON {WORK_SCHEMA}.rede (source)")
+    cur.execute(f"CREATE INDEX idx_rede_tgt ON {WORK_SCHEMA}.rede (target)")
+    for col in display_columns("the_geom"):
+        cur.execute(f"CREATE INDEX idx_rede_{col} ON {WORK_SCHEMA}.rede USING GIST({col})")
+    cur.execute(f"CREATE INDEX idx_rv_geom ON {WORK_SCHEMA}.rede_vertices_pgr USING GIST(geom)")
+
+    # Ordena as arestas pelo indice espacial: vizinhas no mapa ficam nas mesmas paginas
+    cur.execute(f"CLUSTER {WORK_SCHEMA}.rede USING idx_rede_geom")
+    cur.execute(f"CLUSTER {WORK_SCHEMA}.rede_vertices_pgr USING idx_rv_geom")
+    c.commit()
+    log(f"  Indices e CLUSTER ({time.time()-t1:.0f}s)")
+
+    cur.execute("SELECT COUNT(*) FILTER (WHERE elev_source != elev_target AND elev_source > 0) FROM rede")
+    log(f"  {cur.fetchone()[0]} arestas com desnivel")
+    cur.close()
+    c.close()
+
+    # VACUUM nao roda dentro de transacao
+    c = get_conn(autocommit=True)
+    c.execute(f"VACUUM ANALYZE {WORK_SCHEMA}.rede")
+    c.execute(f"VACUUM ANALYZE {WORK_SCHEMA}.rede_vertices_pgr")
+    c.close()
+
+
+# 11: Contraction hierarchies
+
+def build_contraction_hierarchies():
+    """Reconstroi a CH de cada perfil sempre que os pesos de rede mudarem."""
+    log("[11/11] Construindo contraction hierarchies...")
+    c = get_conn()
+    cur = c.cursor()
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {WORK_SCHEMA}.ch_meta (
+            perfil TEXT PRIMARY KEY,
+            assinatura TEXT,
+            criado_em TIMESTAMPTZ DEFAULT now()
+        )
+    """)
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {WORK_SCHEMA}.ch_ordem (
+            perfil TEXT,
+            vertice INTEGER,
+            nivel INTEGER,
+            PRIMARY KEY (perfil, vertice)
+        )
+    """)
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {WORK_SCHEMA}.ch_arcos (
+            perfil TEXT,
+            id INTEGER,
+            source INTEGER,
+            target INTEGER,
+            cost DOUBLE PRECISION,
+            edge INTEGER,
+            filho1 INTEGER,
+            filho2 INTEGER,
+            PRIMARY KEY (perfil, id)
+        )
+    """)
+    c.commit()
+
+    g = Graph.from_db(cur)
+    for perfil in PERFIS:
+        assinatura = g.signature(perfil)
+        cur.execute("SELECT assinatura FROM ch_meta WHERE perfil = %s", (perfil,))
+        row = cur.fetchone()
+        if row and row[0] == assinatura:
+            log(f"  {perfil}: pesos inalterados, CH mantida")
+            continue
+        t1 = time.time()
+        h = Hierarchy.build(g, perfil)
+        h.save(cur, g, perfil, assinatura)
+        c.commit()
+        log(f"  {perfil}: {g.n_vertices} vertices, {h.n_shortcuts} atalhos ({time.time()-t1:.0f}s)")
+
+    cur.close()
+    c.close()
+
+
+def build_landmarks():
+    """Tabelas de distancia do ALT por perfil, refeitas sempre que os pesos de rede mudarem."""
+    log("  Selecionando landmarks do ALT...")
+    c = get_conn()
+    cur = c.cursor()
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {WORK_SCHEMA}.alt_meta (
+            perfil TEXT PRIMARY KEY,
+            assinatura TEXT,
+            criado_em TIMESTAMPTZ DEFAULT now()
+        )
+    """)
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {WORK_SCHEMA}.alt_distancias (
+            perfil TEXT,
+            ordem INTEGER,
+            vertice INTEGER,
+            de BYTEA,
+            para BYTEA,
+            PRIMARY KEY (perfil, ordem)
+        )
     """)
     c.commit()
 
-    cur.execute("SELECT COUNT(*) FROM rede WHERE elev_source != elev_target AND elev_source > 0")
-    n_elev = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM rede WHERE eh_rodovia")
-    n_rod = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM rede WHERE eh_obra_arte")
-    n_oa = cur.fetchone()[0]
-    log(f"  {n_elev} arestas com desnivel")
-    cur.execute("SELECT COUNT(*) FROM rede WHERE eh_ciclovia")
-    n_rc = cur.fetchone()[0]
+    g = Graph.from_db(cur)
+    for perfil in PERFIS:
+        assinatura = g.signature(perfil)
+        cur.execute("SELECT assinatura FROM alt_meta WHERE perfil = %s", (perfil,))
+        row = cur.fetchone()
+        if row and row[0] == assinatura:
+            log(f"  {perfil}: pesos inalterados, landmarks mantidos")
+            continue
+        t1 = time.time()
+        lm = Landmarks.build(g, perfil)
+        lm.save(cur, perfil, assinatura)
+        c.commit()
+        mb = (lm.de.nbytes + lm.para.nbytes) / 1e6
+        log(f"  {perfil}: {len(lm.vertices)} landmarks, {mb:.1f} MB em float32 ({time.time()-t1:.1f}s)")
+
+    cur.close()
+    c.close()
 
 
+def stamp_network_version():
+    """Carimbo de versao da rede: a API invalida o cache de rotas quando ele muda."""
+    versao = uuid.uuid4().hex
+    c = get_conn()
+    cur = c.cursor()
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {WORK_SCHEMA}.rede_versao (versao TEXT, criado_em TIMESTAMPTZ DEFAULT now())")
+    cur.execute(f"DELETE FROM {WORK_SCHEMA}.rede_versao")
+    cur.execute(f"INSERT INTO {WORK_SCHEMA}.rede_versao (versao) VALUES (%s)", (versao,))
+    c.commit()
     cur.close()
     c.close()
+    log(f"  Versao da rede: {versao}")
+
+
+def publish_network():
+    """Copia as tabelas usadas pela API para um schema sombra e troca os schemas numa transacao.
+
+    A API usa search_path = SCHEMA, public: ate o commit ela ve a rede anterior inteira,
+    depois a nova inteira.
+    """
+    log(f"  Publicando rede no schema '{SCHEMA}'...")
+    novo, antigo = f"{SCHEMA}_novo", f"{SCHEMA}_antigo"
+    c = get_conn()
+    cur = c.cursor()
+    cur.execute(f"DROP SCHEMA IF EXISTS {novo} CASCADE")
+    cur.execute(f"CREATE SCHEMA {novo}")
+    for tabela in PUBLISHED_TABLES:
+        cur.execute(f"CREATE TABLE {novo}.{tabela} AS TABLE {WORK_SCHEMA}.{tabela}")
+        cur.execute("SELECT indexdef FROM pg_indexes WHERE schemaname = %s AND tablename = %s",
+                    (WORK_SCHEMA, tabela))
+        for (indexdef,) in cur.fetchall():
+            cur.execute(indexdef.replace(f" ON {WORK_SCHEMA}.{tabela} ", f" ON {novo}.{tabela} "))
+    c.commit()
+    for tabela in PUBLISHED_TABLES:
+        cur.execute(f"ANALYZE {novo}.{tabela}")
+    c.commit()
+
+    cur.execute(f"DROP SCHEMA IF EXISTS {antigo} CASCADE")
+    cur.execute("SELECT 1 FROM pg_namespace WHERE nspname = %s", (SCHEMA,))
+    if cur.fetchone():
+        cur.execute(f"ALTER SCHEMA {SCHEMA} RENAME TO {antigo}")
+    cur.execute(f"ALTER SCHEMA {novo} RENAME TO {SCHEMA}")
+    c.commit()
+    cur.execute(f"DROP SCHEMA IF EXISTS {antigo} CASCADE")
+    c.commit()
+    cur.close()
+    c.close()
+    log("  OK")
+
+
+def export_graph_snapshot():
+    """Exporta o grafo da rede publicada para GRAFO_DIR/<versao>; a API o abre com mmap."""
+    log("  Exportando snapshot do grafo...")
+    t1 = time.time()
+    c = get_conn()
+    cur = c.cursor()
+    cur.execute("SELECT versao FROM rede_versao")
+    versao = cur.fetchone()[0]
+    g = Graph.from_db(cur)
+    g.load_alt(cur)
+    g.load_ch(cur)
+    cur.execute("SELECT id, logradouro, tipo_logradouro FROM rede ORDER BY id")
+    rows = cur.fetchall()
+    cur.close()
+    c.close()
+    ids, logradouros, tipos = zip(*rows) if rows else ((), (), ())
+    g.set_names(ids, logradouros, tipos)
+
+    g.save(GRAFO_DIR / versao, versao)
+    # Troca atomica do ponteiro; processos com a versao anterior mapeada seguem validos
+    tmp = GRAFO_DIR / "atual.tmp"
+    tmp.write_text(versao)
+    os.replace(tmp, GRAFO_DIR / "atual")
+    for d in GRAFO_DIR.iterdir():
+        if d.is_dir() and d.name != versao:
+            shutil.rmtree(d)
+    mb = sum(f.stat().st_size for f in (GRAFO_DIR / versao).iterdir()) / 1e6
+    log(f"  {GRAFO_DIR / versao}: {g.n_vertices} vertices, {g.n_arcs} arcos, {mb:.1f} MB ({time.time()-t1:.1f}s)")
+
+
+# Pipeline incremental
+
+# Etapa: (funcao, codigo/parametros extras que entram na assinatura, CSVs, dependencias).
+# Assinatura = codigo + checksum dos CSVs + assinaturas das dependencias; a etapa so roda
+# se a assinatura mudou, se nao terminou na execucao anterior ou se uma dependencia rodou.
+ETAPAS = {
+    **{f"dados.{t}": (load_data, (load_chunk, split_csv, create_indexes, d), [d[0]], [])
+       for t, d in DATASETS.items()},
+    "rede": (build_network, (), [], ["dados.circulacao_viaria"]),
+    "geometrias": (build_display_geometries, (DISPLAY_TABLES, SIMPLIFY_BANDS), [],
+                   ["rede", "dados.rota_cicloviaria", "dados.faixa_rodagem_rodovia",
+                    "dados.logradouro_obra_de_arte"]),
+    "classificacao": (classify_edges, (CLASSIFICACAO, SUBDIVIDE_VERTICES), [],
+                      ["rede", "dados.faixa_rodagem_rodovia", "dados.logradouro_obra_de_arte",
+                       "dados.rota_cicloviaria"]),
+    "elevacao": (interpolate_elevation, (copy_array, build_dem, sample_dem, DEM_RES, DEM_STEP),
+                 [], ["rede", "dados.curva_nivel_5m"]),
+    "custos": (calculate_costs, (cost_sql, strong_components, Graph._labels, Graph.islands,
+                                 display_columns, CUSTO_PADRAO, SIMPLIFY_BANDS), [],
+               ["geometrias", "classificacao", "elevacao"]),
+    "ch": (build_contraction_hierarchies, (), [], ["custos"]),
+    "alt": (build_landmarks, (Landmarks,), [], ["custos"]),
+    "versao": (stamp_network_version, (), [], ["ch", "alt"]),
+    "publicacao": (publish_network, (PUBLISHED_TABLES,), [], ["versao"]),
+    "snapshot": (export_graph_snapshot, (Graph.save, Graph.open, Graph.set_names), [], ["publicacao"]),
+}
+
+# Tabelas UNLOGGED de cada etapa: sao esvaziadas se o servidor cair, e ai a etapa e refeita
+SAIDAS = {
+    "rede": ["rede_arestas", "rede_vertices_base", "rede_topologia"],
+    "geometrias": ["rede_exibicao"],
+    "classificacao": ["rede_flags"],
+    "elevacao": ["rede_vertices_elev", "rede_elevacao"],
+}
+
+
+def file_checksum(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        while block := f.read(1 << 20):
+            h.update(block)
+    return h.hexdigest()
+
+
+def stage_signatures():
+    """Assinatura de cada etapa, na ordem do pipeline."""
+    assinaturas = {}
+    for nome, (func, extras, arquivos, deps) in ETAPAS.items():
+        h = hashlib.sha1(nome.encode())
+        for x in (func, *extras):
+            h.update((inspect.getsource(x) if callable(x) else repr(x)).encode())
+        for arquivo in arquivos:
+            h.update(file_checksum(DATA / arquivo).encode())
+        for d in deps:
+            h.update(assinaturas[d].encode())
+        assinaturas[nome] = h.hexdigest()
+    return assinaturas
+
+
+def record_stage(nome, assinatura, segundos):
+    c = get_conn()
+    cur = c.cursor()
+    cur.execute(f"""
+        INSERT INTO {WORK_SCHEMA}.setup_etapas (etapa, assinatura, segundos) VALUES (%s, %s, %s)
+        ON CONFLICT (etapa) DO UPDATE
+        SET assinatura = EXCLUDED.assinatura, segundos = EXCLUDED.segundos, concluida_em = now()
+    """, (nome, assinatura, segundos))
+    c.commit()
+    cur.close()
+    c.close()
+
+
+def plan_stages(refazer=()):
+    """Etapas a executar; apaga o registro delas antes de comecar (retomada apos falha)."""
+    assinaturas = stage_signatures()
+    c = get_conn()
+    cur = c.cursor()
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {WORK_SCHEMA}.setup_etapas (
+            etapa TEXT PRIMARY KEY,
+            assinatura TEXT,
+            segundos DOUBLE PRECISION,
+            concluida_em TIMESTAMPTZ DEFAULT now()
+        )
+    """)
+    cur.execute(f"SELECT etapa, assinatura FROM {WORK_SCHEMA}.setup_etapas")
+    feitas = dict(cur.fetchall())
+    for nome, tabelas in SAIDAS.items():
+        for tabela in tabelas:
+            cur.execute("SELECT to_regclass(%s)", (f"{WORK_SCHEMA}.{tabela}",))
+            if cur.fetchone()[0] is None:
+                feitas.pop(nome, None)
+                continue
+            cur.execute(f"SELECT EXISTS (SELECT 1 FROM {WORK_SCHEMA}.{tabela})")
+            if not cur.fetchone()[0]:
+                feitas.pop(nome, None)
+    cur.execute("SELECT 1 FROM pg_namespace WHERE nspname = %s", (SCHEMA,))
+    publicado = cur.fetchone() is not None
+
+    pendentes = set()
+    for nome, (_, _, _, deps) in ETAPAS.items():
+        if (feitas.get(nome) != assinaturas[nome] or nome in refazer
+                or any(d in pendentes for d in deps)):
+            pendentes.add(nome)
+    if not publicado:
+        pendentes.add("publicacao")
+        pendentes.add("snapshot")
+    if not (GRAFO_DIR / "atual").exists():
+        pendentes.add("snapshot")
+    cur.execute(f"DELETE FROM {WORK_SCHEMA}.setup_etapas WHERE etapa = ANY(%s)", (list(pendentes),))
+    c.commit()
+    cur.close()
+    c.close()
+    return [n for n in ETAPAS if n in pendentes], assinaturas
 
 
 def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--reset", action="store_true", help="apaga o banco e refaz todas as etapas")
+    ap.add_argument("--refazer", nargs="*", default=[], choices=list(ETAPAS), metavar="ETAPA",
+                    help=f"forca etapas (e dependentes): {', '.join(ETAPAS)}")
+    args = ap.parse_args()
+
     t0 = time.time()
     log("\n=== CICLOROTA BH - SETUP ===\n")
 
     check_files()
-    create_database()
+    create_database(args.reset)
     create_extensions()
-    load_data()
-    create_indexes()
-    build_network()
-    classify_edges()
-    interpolate_elevation()
-    calculate_costs()
+
+    pendentes, assinaturas = plan_stages(args.refazer)
+    log(f"  Etapas a executar: {', '.join(pendentes) or 'nenhuma'}")
+
+    # Datasets alterados sao carregados juntos, em paralelo
+    dados = [n.split(".", 1)[1] for n in pendentes if n.startswith("dados.")]
+    if dados:
+        t1 = time.time()
+        load_data(dados)
+        create_indexes(dados)
+        for t in dados:
+            record_stage(f"dados.{t}", assinaturas[f"dados.{t}"], time.time() - t1)
+
+    for nome in pendentes:
+        if nome.startswith("dados."):
+            continue
+        t1 = time.time()
+        ETAPAS[nome][0]()
+        record_stage(nome, assinaturas[nome], time.time() - t1)
 
     log(f"\n=== CONCLUIDO em {time.time()-t0:.0f}s ===")
     log("Rode: python app.py")
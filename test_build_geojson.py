@@ -0,0 +1,186 @@
+"""
+Teste de regressao de build_geojson - CicloRota BH.
+Compara build_geojson com o laco original, mantido aqui como referencia,
+em rotas aleatorias com None, 0, negativos e mistura de int/float.
+Benchmark: python test_build_geojson.py
+"""
+
+import random, time
+import orjson
+import pytest
+from app import build_geojson
+
+
+def build_geojson_referencia(rows):
+    """Implementacao original (laco por trecho), antes da versao com NumPy."""
+    features = []
+    dist = 0.0
+    subida_total = 0.0
+    descida_total = 0.0
+    trechos_rodovia = 0
+    trechos_obra_arte = 0
+    trechos_ciclovia = 0
+    dist_rodovia = 0.0
+    dist_obra_arte = 0.0
+    dist_ciclovia = 0.0
+    prev_elev = None
+
+    for seq, edge_id, logr, tipo, comp, es, et, rod, oa, cic, geojson in rows:
+        comp = comp or 0
+        es = es or 0
+        et = et or 0
+
+        if rod:
+            trechos_rodovia += 1
+            dist_rodovia += comp
+        if oa:
+            trechos_obra_arte += 1
+            dist_obra_arte += comp
+        if cic:
+            trechos_ciclovia += 1
+            dist_ciclovia += comp
+
+        # Ajusta sentido do trecho pela continuidade da rota
+        if prev_elev is not None and es > 0 and et > 0:
+            if abs(es - prev_elev) <= abs(et - prev_elev):
+                ei, ef = es, et
+            else:
+                ei, ef = et, es
+        else:
+            ei, ef = es, et
+
+        desnivel = ef - ei
+        slope = (desnivel / comp * 100) if comp > 0 else 0
+        prev_elev = ef
+
+        if desnivel > 0:
+            subida_total += desnivel
+        else:
+            descida_total += abs(desnivel)
+
+        if geojson:
+            features.append({
+                "type": "Feature",
+                "geometry": orjson.Fragment(geojson),
+                "properties": {
+                    "seq": seq,
+                    "logradouro": logr or "",
+                    "tipo": tipo or "",
+                    "comprimento": round(comp, 1),
+                    "elev_inicio": round(ei, 1),
+                    "elev_fim": round(ef, 1),
+                    "desnivel": round(desnivel, 1),
+                    "inclinacao": round(slope, 1),
+                    "eh_rodovia": bool(rod),
+                    "eh_obra_arte": bool(oa),
+                    "eh_ciclovia": bool(cic),
+                },
+            })
+        dist += comp
+
+    return {
+        "rota": {"type": "FeatureCollection", "features": features},
+        "resumo": {
+            "distancia_m": round(dist, 1),
+            "subida_total_m": round(subida_total, 1),
+            "descida_total_m": round(descida_total, 1),
+            "trechos": len(rows),
+            "trechos_rodovia": trechos_rodovia,
+            "dist_rodovia_m": round(dist_rodovia, 1),
+            "trechos_obra_arte": trechos_obra_arte,
+            "dist_obra_arte_m": round(dist_obra_arte, 1),
+            "trechos_ciclovia": trechos_ciclovia,
+            "dist_ciclovia_m": round(dist_ciclovia, 1),
+        },
+    }
+
+
+GEOJSON = '{"type":"LineString","coordinates":[[-43.9,-19.9],[-43.91,-19.91]]}'
+
+
+def elevacao(rnd):
+    r = rnd.random()
+    if r < 0.05:
+        return None
+    if r < 0.1:
+        return 0.0
+    if r < 0.12:
+        return -rnd.random() * 5
+    # Valores com empate de arredondamento e ints vindos do banco
+    return rnd.choice([rnd.uniform(700, 1000), round(rnd.uniform(700, 1000)), 800.0, 800.05, 2.675])
+
+
+def rota_aleatoria(rnd, n):
+    return [(i + 1, 100 + i, rnd.choice([None, "Rua A"]), rnd.choice([None, "RUA"]),
+             rnd.choice([None, 0, 0.0, -1.0, rnd.uniform(0, 300), 0.25, 50, 10.05]),
+             elevacao(rnd), elevacao(rnd),
+             rnd.choice([None, True, False]), rnd.choice([None, True, False]),
+             rnd.choice([True, False]), rnd.choice([None, GEOJSON]))
+            for i in range(n)]
+
+
+def rota_continua(rnd, n):
+    # Trechos encadeados como numa rota real: cada um comeca na elevacao em que o
+    # anterior termina, metade deles percorrida de target para source
+    rows, elev = [], 800.0
+    for i in range(n):
+        prox = rnd.choice([round(elev + rnd.uniform(-5, 5), 2), round(elev + rnd.uniform(-5, 5)), None])
+        es, et = (elev, prox) if rnd.random() < 0.5 else (prox, elev)
+        rows.append((i + 1, 100 + i, "Rua A", "RUA", rnd.uniform(5, 300), es, et,
+                     rnd.random() < 0.1, rnd.random() < 0.05, rnd.random() < 0.2,
+                     rnd.choice([GEOJSON] * 9 + [None])))
+        elev = prox or 800.0
+    return rows
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_rotas_aleatorias(seed):
+    rnd = random.Random(seed)
+    for _ in range(300):
+        rows = rota_aleatoria(rnd, rnd.randint(0, 15))
+        assert orjson.dumps(build_geojson(rows)) == orjson.dumps(build_geojson_referencia(rows)), rows
+
+
+def test_rota_longa():
+    rows = rota_aleatoria(random.Random(42), 5000)
+    assert orjson.dumps(build_geojson(rows)) == orjson.dumps(build_geojson_referencia(rows))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_rota_continua(seed):
+    rows = rota_continua(random.Random(seed), 500)
+    assert orjson.dumps(build_geojson(rows)) == orjson.dumps(build_geojson_referencia(rows))
+
+
+def test_rota_vazia():
+    assert build_geojson([]) == build_geojson_referencia([])
+
+
+def test_subida_amostrada():
+    # Aresta 2 percorrida de target para source: sua subida e a descida amostrada
+    rows = [(1, 1, "Rua A", "RUA", 100.0, 800.0, 810.0, False, False, False, 12.0, 2.0, GEOJSON),
+            (2, 2, "Rua A", "RUA", 100.0, 805.0, 810.0, False, False, False, 1.5, 6.5, GEOJSON),
+            (3, 3, "Rua A", "RUA", 50.0, 805.0, 805.0, False, False, False, None, None, GEOJSON)]
+    sem = [r[:10] + r[12:] for r in rows]
+    g = build_geojson(rows)
+    assert g["resumo"]["subida_total_m"] == 18.5
+    assert g["resumo"]["descida_total_m"] == 3.5
+    # Trechos iguais aos das linhas sem as colunas amostradas
+    assert orjson.dumps(g["rota"]) == orjson.dumps(build_geojson(sem)["rota"])
+    assert build_geojson(sem)["resumo"]["subida_total_m"] == 10.0
+
+
+if __name__ == "__main__":
+    for gerador in (rota_continua, rota_aleatoria):
+        for n in (50, 500, 5000):
+            rows = gerador(random.Random(1), n)
+            rep = max(20, 20000 // n)
+            tempos = {}
+            for _ in range(5):
+                for nome, f in (("referencia", build_geojson_referencia), ("build_geojson", build_geojson)):
+                    t0 = time.perf_counter()
+                    for _ in range(rep):
+                        f(rows)
+                    tempos[nome] = min(tempos.get(nome, 1e9), (time.perf_counter() - t0) / rep * 1000)
+            print(f"{gerador.__name__} {n:5d} trechos: " +
+                  ", ".join(f"{k} {v:.3f} ms" for k, v in tempos.items()))